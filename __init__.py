@@ -10,6 +10,8 @@ from header import Header
 
 DEFAULT_PORT = 8336
 DEFAULT_HOST = "localhost"
+DEFAULT_WINDOW = 1024
+UNIX_PREFIX = "unix:"
 
 class NeuroError(Exception):
     pass
@@ -20,6 +22,35 @@ class NeuroTimeout(NeuroError):
 class NeuroDeviceError(NeuroError):
     pass
 
+def connect(address):
+    r"""Opens a stream socket to address, a (host, port) pair or
+    'unix:<path>' for a UNIX domain socket.
+    """
+    if isinstance(address, basestring):
+        if not address.startswith(UNIX_PREFIX) or not hasattr(socket, 'AF_UNIX'):
+            raise NeuroError("Unsupported address {0}.".format(address))
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(address[len(UNIX_PREFIX):])
+        except socket.error:
+            sock.close()
+            raise
+        return sock
+    return socket.create_connection(address)
+
+def formatAddress(address):
+    if isinstance(address, tuple):
+        return '{0}:{1}'.format(*address[:2])
+    return str(address)
+
+def peerAddress(sock):
+    r"""Returns the address of the peer of sock, for UNIX domain sockets
+    the path it is connected through.
+    """
+    if hasattr(socket, 'AF_UNIX') and sock.family == socket.AF_UNIX:
+        return UNIX_PREFIX + sock.getsockname()
+    return sock.getpeername()
+
 class NeuroDevice:
     def __init__(self, header):
         self.header = header
@@ -48,12 +79,15 @@ class Neuro:
         self.socket = None
     
     def send(self, data, sock = None):
+        return self.sendRaw(data+'\r\n', sock)
+    
+    def sendRaw(self, data, sock = None):
         if sock is None:
             sock = self.socket
         if sock is None:
             raise NeuroError("Socket is not open.")
         try:
-            return sock.send(data+'\r\n')
+            return sock.sendall(data)
         except socket.timeout:
             raise NeuroTimeout("Timeout writting to socket.")
         except socket.error as e:
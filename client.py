@@ -9,7 +9,24 @@ from Queue import Queue,Full,Empty
 
 from time import sleep
 
-from pyneuro import NeuroError,NeuroTimeout,Neuro,Header
+from collections import deque
+
+from pyneuro import NeuroError,NeuroTimeout,Neuro,Header,connect,formatAddress
+from pyneuro.eventloop import Poller,wait
+from pyneuro.framer import LineFramer
+from pyneuro.samples import SampleBlock,INT16,fromPackets,fromLines,parseLines,fitsInt16
+from pyneuro.clock import monotonic
+from pyneuro.stats import Histogram
+from pyneuro.ring import ChannelRing,numpy
+
+STAMPS_KEPT = 1024
+# seconds between attempts to reconnect, doubled after every failure
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+# seconds of history requested on top of the time disconnected
+RESUME_MARGIN = 1.0
+DEFAULT_STREAM_BLOCKS = 1024
+RE_STATUS = re.compile(r'([0-9]+)\s+clients connected')
 
 class NeuroClient(Neuro):
     def __init__(self, address, device, role):
@@ -20,9 +37,17 @@ class NeuroClient(Neuro):
         if len(msg) < 6 or cmp(msg[0:6],"200 OK") != 0:
             raise NeuroError("Wrong response.")
 
+    def sendFormat(self, fmt):
+        r"""Switches sample blocks of this connection to binary frames of
+        format fmt ('float32' or 'int16').
+        """
+        self.send("binary "+fmt)
+        msg = self.recv()
+        self.checkResponse(msg)
+
     def open(self):
         try:
-            self.socket = socket.create_connection(self.address)
+            self.socket = connect(self.address)
             self.send(self.role)
             msg = self.recv()
             self.checkResponse(msg)
@@ -30,9 +55,20 @@ class NeuroClient(Neuro):
             raise NeuroError("Error opening socket.")
 
 class NeuroClientEEG(NeuroClient):
-    def __init__(self, address, device):
+    r"""Uploads the samples of device to the server.
+    By default every sample is acknowledged before the next one is sent.
+    With window set, samples are streamed and the server acknowledges them
+    in batches; at most 'window' samples are left unacknowledged, a window
+    of 0 disables flow control and only errors are reported.
+    """
+    def __init__(self, address, device, binary = None, window = None):
         NeuroClient.__init__(self, address, device, "eeg")
         self.device = device
+        self.binary = binary
+        self.window = window
+        self.framer = LineFramer()
+        self.sent = 0
+        self.acked = 0
         self.lastSeq = -1
         self.samples = -1
 
@@ -44,27 +80,77 @@ class NeuroClientEEG(NeuroClient):
         except socket.error:
             raise NeuroError("Error opening socket.")
 
-    def sendData(self):
-        for packet in self.device.getData():
-            if self.lastSeq > -1 and self.lastSeq + 1 != packet[0]:
-                #raise NeuroError("Sequence number not consistent.")
-                print "Sequence number not consistent."
-                self.lastSeq = packet[0]
+    def sendStream(self):
+        self.send("stream {0}".format(self.window))
+        msg = self.recv()
+        self.checkResponse(msg)
+
+    def formatPacket(self, packet):
+        if self.lastSeq > -1 and self.lastSeq + 1 != packet[0]:
+            #raise NeuroError("Sequence number not consistent.")
+            print "Sequence number not consistent."
             self.lastSeq = packet[0]
-            if self.samples > 0:
-                if self.samples != packet[1] and self.samples + 2 != len(packet):
-                    raise NeuroError("Packet size not consistent.")
+        self.lastSeq = packet[0]
+        if self.samples > 0:
+            if self.samples != packet[1] and self.samples + 2 != len(packet):
+                raise NeuroError("Packet size not consistent.")
+        else:
+            self.samples = packet[1]
+        # FIXME: bastl:
+        s = "".join([ " {"+str(i+2)+"}" for i in range(self.samples) ])
+        return ("! {0} {1}"+ s).format(*packet)
+
+    def recvAcks(self, timeout):
+        r"""Processes acknowledgements of streamed samples, waiting at most
+        timeout seconds (None waits forever) for the first one to arrive.
+        """
+        try:
+            r, w = wait([self.socket.fileno()], [], timeout)
+            if len(r) == 0:
+                return
+            lines = self.framer.recv(self.socket)
+        except socket.error as e:
+            raise NeuroError("Error reading socket: {0}".format(e))
+        if lines is None:
+            raise NeuroError("Connection closed by server.")
+        for msg in lines:
+            self.checkResponse(msg)
+            if len(msg) > 6:
+                self.acked = int(msg[6:])
+
+    def sendData(self):
+        packets = self.device.getData()
+        if self.window is not None:
+            if self.binary is not None:
+                data = "".join([ block.encode(self.binary) for block in fromPackets(0, packets) ])
             else:
-                self.samples = packet[1]
-            # FIXME: bastl:
-            s = "".join([ " {"+str(i+2)+"}" for i in range(self.samples) ])
-            self.send(("! {0} {1}"+ s).format(*packet))
+                data = "".join([ self.formatPacket(packet)+'\r\n' for packet in packets ])
+            while self.window > 0 and self.sent - self.acked >= self.window:
+                self.recvAcks(None)
+            self.sendRaw(data)
+            self.sent += len(packets)
+            self.recvAcks(0)
+            return
+        if self.binary is not None:
+            for block in fromPackets(0, packets):
+                self.sendRaw(block.encode(self.binary))
+                msg = self.recv()
+                self.checkResponse(msg)
+            return
+        for packet in packets:
+            self.send(self.formatPacket(packet))
             msg = self.recv()
             self.checkResponse(msg)
     
     def run(self):
+        if self.binary == INT16 and not fitsInt16(self.device.getHeader()):
+            raise NeuroError("Samples of the device do not fit int16 frames.")
         NeuroClient.run(self)
         self.sendHeader()
+        if self.binary is not None:
+            self.sendFormat(self.binary)
+        if self.window is not None:
+            self.sendStream()
         while True:
             self.sendData()
 
@@ -74,7 +160,12 @@ class NeuroSocketProducer(Thread):
         self.caller = caller
         self.queues = {}
         self.clients = {}
-        self.lastSeq = None
+        self.lastSeq = {}
+        self.skip = {}
+        self.gaps = 0
+        self.framer = LineFramer()
+        self.pending = deque()
+        self.received = monotonic()
         self.name = "ReceiverThread"
         self.daemon = True
 
@@ -86,46 +177,166 @@ class NeuroSocketProducer(Thread):
         return self.queues[clId]
     
     def parseSamples(self, lines):
+        run = [] # consecutive '!' lines, parsed together
         for line in lines: # self.recvLines():
-            if cmp(line[0:6],"200 OK") == 0:
+            if not isinstance(line, SampleBlock) and line[0:1] == '!':
+                run.append(line)
                 continue
-            line = line.split()
-            if len(line) < 1 or line[0] != '!':
-                #raise NeuroError("Wrong packet received.")
+            if len(run) > 0:
+                self.parseRun(run)
+                run = []
+            if isinstance(line, SampleBlock):
+                self.parseBlock(line)
+            elif line[0:1] == '@':
+                self.parseStamp(line)
+            elif cmp(line[0:6],"200 OK") != 0:
                 print "Wrong packet received."
+        if len(run) > 0:
+            self.parseRun(run)
+
+    def parseRun(self, lines):
+        r"""Parses '!' lines at once with parseLines(), line by line if
+        numpy is missing or the lines are malformed.
+        """
+        blocks = parseLines(lines)
+        if blocks is not None:
+            for clId, seq, values in blocks:
+                self.addSamples(clId, seq, values.shape[0], values.T)
+            return
+        for line in lines:
+            line = line.split()
             try:
                 clId, seq , nSampl = [ int(i) for i in line[1:4] ]
+                sampl = [ float(i) for i in line[4:] ]
             except ValueError:
                 #raise NeuroError("Wrong packet received.")
                 print "Wrong packet received."
+                continue
+            if nSampl != len(sampl):
+                print "Wrong packet length."
+                continue
+            self.addSamples(clId, seq, 1, [ [v] for v in sampl ])
 
-            sampl = [ float(i) for i in line[4:] ]
-           
-            if self.lastSeq is not None:
-                if seq != self.lastSeq + 1:
-                    self.lastSeq = seq
-                    #raise NeuroError("Packet sequence error (seq = {0}).".format(seq))
-                    print "Oops! Packet sequence error (seq = {0}).".format(seq)
+    def addSamples(self, clId, seq, count, columns):
+        r"""Appends count samples of clId starting at seq, given as one list
+        or numpy row per channel, to the ring buffer of clId if the caller
+        keeps them, otherwise to the lists of the next enqueueSamples().
+        A sequence gap before them is reported and counted.
+        """
+        if clId in self.skip:
+            # samples received before the connection was lost
+            skip = self.skip[clId] + 1 - seq
+            if skip >= count:
+                return
+            if skip > 0:
+                if isinstance(columns, list):
+                    columns = [ c[skip:] for c in columns ]
                 else:
-                    self.lastSeq = self.lastSeq + 1
-            else:
-                self.lastSeq = seq
+                    columns = columns[:,skip:]
+                seq += skip
+                count -= skip
+            del self.skip[clId]
+        last = self.lastSeq.get(clId)
+        self.lastSeq[clId] = seq + count - 1
+        if last is not None and seq != last + 1:
+            self.gaps += 1
+            #raise NeuroError("Packet sequence error (seq = {0}).".format(seq))
+            print "Oops! Packet sequence error (client {0}, seq = {1} after {2}).".format(clId, seq, last)
+        if self.caller.ringSize is not None:
+            self.caller.getRing(clId, len(columns)).put(columns)
+            return
+        if not isinstance(columns, list):
+            columns = columns.tolist()
+        if clId not in self.clients:
+            self.clients[clId] = tuple([ [] for i in range(len(columns)) ]) # tuple of empty lists
+        if len(columns) != len(self.clients[clId]):
+            #raise NeuroError("Wrong packet length.")
+            print "Wrong packet length."
+            return
+        for i in range(len(columns)):
+            self.clients[clId][i].extend(columns[i])
+    
+    def parseStamp(self, line):
+        try:
+            at, clId, seq, t = line.split()
+            self.caller.addStamp(int(clId), int(seq), float(t))
+        except ValueError:
+            print "Wrong timestamp received."
 
-            if clId not in self.clients:
-                self.clients[clId] = tuple([[]]*nSampl) # tuple of empty lists
-            if nSampl != len(self.clients[clId]):
-                #raise NeuroError("Wrong packet length.")
-                print "Wrong packet length."
-            for i in range(nSampl):
-                self.clients[clId][i].append(sampl[i])
+    def parseBlock(self, block):
+        n = block.nChannels
+        if self.caller.ringSize is not None:
+            self.addSamples(block.clId, block.seq, block.count, block.getArray().T)
+            return
+        values = block.getValues()
+        self.addSamples(block.clId, block.seq, block.count, [ values[i::n] for i in range(n) ])
     
+    def resume(self, clId, first, count):
+        r"""Takes the reply to 'history' after a reconnect to the same server
+        run: count samples of clId starting at first are sent before the live
+        ones. Those received before the connection was lost are skipped.
+        """
+        last = self.lastSeq.get(clId)
+        if last is not None and first <= last:
+            self.skip[clId] = last
+
+    def restart(self, clId):
+        r"""Forgets the sequence numbers of clId after a reconnect to a
+        restarted server or a changed source, which number samples anew.
+        """
+        self.lastSeq.pop(clId, None)
+        self.skip.pop(clId, None)
+
+    def recvReply(self, items):
+        r"""Returns the next reply line, moving the sample lines and blocks
+        received before it to items.
+        """
+        while True:
+            while len(self.pending) > 0:
+                item = self.pending.popleft()
+                if isinstance(item, SampleBlock) or item[0:1] in ('!', '@'):
+                    items.append(item)
+                else:
+                    return item
+            self.pending.extend(self.recvLines())
+
+    def reconnect(self):
+        r"""Reconnects after the connection was lost, waiting RECONNECT_DELAY
+        seconds and twice as long after every failure, until it succeeds or
+        the client terminates. Returns the samples received meanwhile, or
+        None if the client terminated.
+        """
+        delay = RECONNECT_DELAY
+        while not self.caller.terminate.isSet():
+            self.caller.terminate.wait(delay)
+            if self.caller.terminate.isSet():
+                break
+            self.framer = LineFramer()
+            self.pending.clear()
+            items = []
+            try:
+                self.caller.resubscribe(self, items, monotonic() - self.received + RESUME_MARGIN)
+                items.extend(self.pending)
+                self.pending.clear()
+                print "Reconnected to {0}.".format(formatAddress(self.caller.address))
+                return items
+            except NeuroError as e:
+                print "Oops!! Reconnecting to {0} failed: {1}".format(formatAddress(self.caller.address), e)
+            delay = min(2 * delay, RECONNECT_MAX_DELAY)
+        return None
+
     def recvLines(self):
-        msg = self.caller.recv()
-        if msg == '':
-            raise NeuroError("No more data. Is socket open?")
-        while len(msg) < 1 or msg[-1] != '\n':
-            msg += self.caller.recv()
-        return msg.splitlines()
+        lines = []
+        while len(lines) == 0:
+            try:
+                lines = self.framer.recv(self.caller.socket)
+            except socket.timeout:
+                raise NeuroTimeout("Timeout reading socket.")
+            except socket.error as e:
+                raise NeuroError("Error reading socket: {0}".format(e))
+            if lines is None:
+                raise NeuroError("No more data. Is socket open?")
+        return lines
     
     def enqueueSamples(self):
         queues = self.getQueues()
@@ -137,7 +348,7 @@ class NeuroSocketProducer(Thread):
             del self.clients[i]
 
     def run(self):
-        self.lastSeq = -1
+        self.lastSeq = {}
         while not self.caller.terminate.isSet():
             self.caller.watching.wait(1.0)
             if not self.caller.watching.isSet():
@@ -146,23 +357,67 @@ class NeuroSocketProducer(Thread):
                 lines = self.recvLines()
             except NeuroError as e:
                 print "Oops!! {0} got: {1}".format(threading.currentThread().name, e)
-                break
-            self.parseSamples(lines)
+                if not self.caller.reconnect or self.caller.terminate.isSet():
+                    break
+                lines = self.reconnect()
+                if lines is None:
+                    break
+            self.received = monotonic()
+            if self.caller.trace:
+                start = monotonic()
+                self.parseSamples(lines)
+                self.caller.traces['parse'].add(monotonic() - start)
+            else:
+                self.parseSamples(lines)
             self.enqueueSamples()
                 
 
 class NeuroClientDisp(NeuroClient):
-    def __init__(self, address, queueSize = 0):
+    r"""Display client receiving samples of watched EEG clients.
+    With timestamps set, the server precedes every block with its
+    acquisition time; getStamps() returns them converted to the local
+    monotonic clock. trace additionally records the time spent parsing and
+    the latency from acquisition until parsed, see getTrace(). With
+    flushInterval set (seconds), the server coalesces the samples it sends
+    into writes at most that far apart. With reconnect set, a lost
+    connection is reopened and watching resumed, see resubscribe(). With
+    ringSize set, the samples of
+    each watched client are kept in a ChannelRing of that many samples
+    instead of queues, see getLatest() and getSince(); getData() then
+    returns numpy views as well.
+    """
+    Producer = NeuroSocketProducer
+
+    def __init__(self, address, queueSize = 0, binary = None, timestamps = False, trace = False,
+            flushInterval = None, ringSize = None, reconnect = True):
         NeuroClient.__init__(self, address, None, "display")
+        if ringSize is not None and numpy is None:
+            raise NeuroError("numpy is required for ring buffers.")
         self.queueSize = queueSize
+        self.ringSize = ringSize
+        self.reconnect = reconnect
+        self.rates = {}
+        self.rings = {}
+        self.cursors = {}
+        self.binary = binary
+        self.timestamps = timestamps or trace
+        self.trace = trace
+        self.flushInterval = flushInterval
+        self.traces = { 'parse': Histogram(), 'latency': Histogram() }
+        self.stamps = {}
+        self.clockOffset = 0.0
+        self.serverStarted = None
+        self.channels = {}
         self.clients = {}
         self.queues = {}
         self.queuesLock = Lock()
+        # serializes commands and their replies of the caller and the receiver thread
+        self.commandLock = RLock()
         self.watching = Event()
         self.terminate = Event()
         self.watching.clear()
         self.terminate.clear()
-        self.provider = NeuroSocketProducer(self)
+        self.provider = self.Producer(self)
         self.provider.start()
 
     def setRole(self, cl, value):
@@ -178,6 +433,10 @@ class NeuroClientDisp(NeuroClient):
         return self.clients[cl][0]
 
     def getHeader(self, cl):
+        r"""Returns the header of cl, reduced to the watched channels."""
+        channels = self.channels.get(cl)
+        if channels is not None:
+            return self.clients[cl][1].select(channels)
         return self.clients[cl][1]
 
     def isWatching(self, cl):
@@ -204,8 +463,46 @@ class NeuroClientDisp(NeuroClient):
             self.queuesLock.release()
         return q
 
+    def getRing(self, client, nChannels = None):
+        r"""Returns the ring buffer of client. With nChannels given, a new
+        ring replaces a missing one or one of another channel count.
+        """
+        self.queuesLock.acquire()
+        try:
+            ring = self.rings.get(client)
+            if nChannels is not None and (ring is None or ring.nChannels != nChannels):
+                ring = ChannelRing(nChannels, self.ringSize)
+                self.rings[client] = ring
+        finally:
+            self.queuesLock.release()
+        return ring
+
+    def getLatest(self, client, count):
+        r"""Returns a (channels, samples) view of the latest count samples
+        of client, fewer if not received yet.
+        """
+        self.checkProvider()
+        ring = self.getRing(client)
+        if ring is None:
+            raise NeuroError("Client #{0} is not watched.".format(client))
+        return ring.getLatest(count)
+
+    def getSince(self, client, cursor, minLength = 0, timeout = 1.0):
+        r"""Waits at most timeout seconds for minLength samples of client
+        after cursor, 0 for the first call. Returns a (channels, samples)
+        view of the samples received since cursor and the next cursor.
+        """
+        self.checkProvider()
+        ring = self.getRing(client)
+        if ring is None:
+            raise NeuroError("Client #{0} is not watched.".format(client))
+        return ring.getSince(cursor, minLength, timeout)
+
     def getData(self, client, minLength = 0):
         self.checkProvider()
+        if self.ringSize is not None:
+            data, self.cursors[client] = self.getSince(client, self.cursors.get(client, 0), max(minLength, 1))
+            return data
 
         data = ()
         queue = self.getQueues(client)
@@ -230,55 +527,125 @@ class NeuroClientDisp(NeuroClient):
         
         return data
 
-    def recvStatus(self):
-        if self.watching.isSet():
-            return
-        self.send("status")
-        lines = self.recv().splitlines()
-        while len(lines) < 2:
-            sleep(.1)
-            lines.extend(self.recv().splitlines())
-        self.checkResponse(lines.pop(0))
-        m = re.match(r'([0-9]+)\s+clients connected', lines.pop(0))
-        if m is None:
-            raise NeuroError("Unexpected response.")
-        n = int(m.group(1))
-        while len(lines) < n:
-            sleep(.1)
-            lines.extend(self.recv().splitlines())
-        self.clients = {}
-        self.queuesLock.acquire()
+    def syncClock(self):
+        r"""Estimates the offset of the server's monotonic clock against the
+        local one from the round trip of a 'time' command. Returns the start
+        time of the server from the reply, None if the server does not tell.
+        """
+        self.commandLock.acquire()
         try:
-            self.queues = {}
+            if self.watching.isSet():
+                return None
+            start = monotonic()
+            self.send("time")
+            msg = self.recv()
+            end = monotonic()
+            if cmp(msg[0:3], "400") == 0:
+                # servers without 'time' tell neither their clock nor their start
+                return None
+            self.checkResponse(msg)
+            fields = msg.split()
+            try:
+                self.clockOffset = float(fields[2]) - (start + end) / 2
+            except (ValueError, IndexError):
+                raise NeuroError("Unexpected response.")
+            if len(fields) > 3:
+                return fields[3]
+            return None
+        finally:
+            self.commandLock.release()
+
+    def addStamp(self, client, seq, t):
+        t -= self.clockOffset
+        if self.trace:
+            self.traces['latency'].add(monotonic() - t)
+        if client not in self.stamps:
+            self.stamps[client] = deque(maxlen = STAMPS_KEPT)
+        self.stamps[client].append((seq, t))
+
+    def getStamps(self, client):
+        r"""Returns (seq, acquisition time) pairs received for client since the
+        last call; the time is the local monotonic clock. At most STAMPS_KEPT
+        pairs are kept.
+        """
+        stamps = self.stamps.get(client)
+        result = []
+        while stamps:
+            result.append(stamps.popleft())
+        return result
+
+    def getTrace(self):
+        return dict([ (stage, h.items()) for stage,h in self.traces.items() ])
+
+    def requestStatus(self):
+        r"""Returns (client id, role) pairs of the clients of the server."""
+        self.commandLock.acquire()
+        try:
+            self.send("status")
+            lines = self.recv().splitlines()
+            while len(lines) < 2:
+                sleep(.1)
+                lines.extend(self.recv().splitlines())
+            self.checkResponse(lines.pop(0))
+            m = RE_STATUS.match(lines.pop(0))
+            if m is None:
+                raise NeuroError("Unexpected response.")
+            n = int(m.group(1))
+            while len(lines) < n:
+                sleep(.1)
+                lines.extend(self.recv().splitlines())
+            status = []
             for i in range(n):
                 m = re.match(r'([0-9]+):(.*)', lines.pop(0))
                 if m is None:
                     raise NeuroError("Unexpected response.")
                 key, clientType = m.groups()
-                key = int(key)
-                self.clients[key] = [clientType,None,False]
-                if self.getRole(key) == 'EEG':
-                    self.recvHeader(key)
-                    self.queues[key] = Queue(self.queueSize)
+                status.append((int(key), clientType))
+            return status
         finally:
-            self.queuesLock.release()
+            self.commandLock.release()
+
+    def recvStatus(self):
+        self.commandLock.acquire()
+        try:
+            if self.watching.isSet():
+                return
+            status = self.requestStatus()
+            self.clients = {}
+            self.queuesLock.acquire()
+            try:
+                self.queues = {}
+                self.rings = {}
+                for key, clientType in status:
+                    self.clients[key] = [clientType,None,False]
+                    if self.getRole(key) == 'EEG':
+                        self.recvHeader(key)
+                        self.queues[key] = Queue(self.queueSize)
+            finally:
+                self.queuesLock.release()
+        finally:
+            self.commandLock.release()
 
     def recvHeader(self, client):
-        if self.watching.isSet():
-            return
-        if client not in self.clients:
-            self.recvStatus()
+        self.commandLock.acquire()
+        try:
+            if self.watching.isSet():
+                return
             if client not in self.clients:
-                raise NeuroError("Client #{0} not present.".format(client))
-        if self.getRole(client) != 'EEG':
-            raise NeuroError("Client #{0} is not EEG device.".format(client))
-        self.send('getheader {0}'.format(client))
-        lines = self.recv().splitlines()
-        while len(lines) < 2:
-            sleep(.1)
-            lines.extend(self.recv().splitlines())
-        self.checkResponse(lines.pop(0))
-        self.setHeader(client, lines.pop(0))
+                self.recvStatus()
+                if client not in self.clients:
+                    raise NeuroError("Client #{0} not present.".format(client))
+            if self.getRole(client) != 'EEG':
+                raise NeuroError("Client #{0} is not EEG device.".format(client))
+            self.send('getheader {0}'.format(client))
+            lines = self.recv().splitlines()
+            while len(lines) < 2:
+                sleep(.1)
+                lines.extend(self.recv().splitlines())
+            self.checkResponse(lines.pop(0))
+            self.setHeader(client, lines.pop(0))
+        finally:
+            self.commandLock.release()
 
     def unwatch(self, client):
         self.checkProvider()
@@ -286,28 +653,488 @@ class NeuroClientDisp(NeuroClient):
             raise NeuroError("Client #{0} not present.".format(client))
         if self.getRole(client) != 'EEG':
             raise NeuroError("Client #{0} is not EEG device.".format(client))
-        if not self.isWatching(client):
-            return
-        self.send('unwatch {0}'.format(client))
-        self.setWatching(client, False)
-        if not self.isWatchingAny():
-            self.watching.clear()
+        self.commandLock.acquire()
+        try:
+            if not self.isWatching(client):
+                return
+            self.send('unwatch {0}'.format(client))
+            self.rates.pop(client, None)
+            self.setWatching(client, False)
+            if not self.isWatchingAny():
+                self.watching.clear()
+        finally:
+            self.commandLock.release()
 
-    def watch(self, client):
+    def watch(self, client, rate = None, channels = None, history = None):
+        r"""Starts receiving samples of client. With rate set, the server
+        low-pass filters and decimates them by an integer factor to at least
+        rate samples per second; sequence numbers then count the decimated
+        samples. channels is a list of channel indices to receive, in that
+        order. Watching again changes the subscription, a rate of 0 and no
+        channels restore the full stream. With history set, servers keeping
+        a history first send the samples of the last history seconds of a
+        full stream.
+        """
         self.checkProvider()
         if client not in self.clients:
             raise NeuroError("Client #{0} not present.".format(client))
         if self.getRole(client) != 'EEG':
             raise NeuroError("Client #{0} is not EEG device.".format(client))
-        if self.isWatching(client):
-            return
-        self.send('watch {0}'.format(client))
-        self.setWatching(client, True)
-        self.watching.set()
+        self.commandLock.acquire()
+        try:
+            if rate is None and channels is None and self.isWatching(client):
+                return
+            if history is not None and rate is None and channels is None and not self.isWatching(client):
+                # starts watching if the server keeps a history, 'watch' is a no-op then
+                self.send('history {0} {1}'.format(client, history))
+            self.send(self.watchCommand(client, rate, channels))
+            self.rates[client] = rate
+            if channels is None:
+                self.channels.pop(client, None)
+            else:
+                self.channels[client] = tuple(channels)
+            if self.ringSize is not None:
+                self.getRing(client, self.getHeader(client).channelCount)
+            self.setWatching(client, True)
+            self.watching.set()
+        finally:
+            self.commandLock.release()
+
+    def watchCommand(self, client, rate = None, channels = None):
+        cmd = 'watch {0}'.format(client)
+        if rate is not None:
+            cmd += ' {0}'.format(rate)
+        if channels is not None:
+            cmd += ' channels ' + ','.join([ str(c) for c in channels ])
+        return cmd
+
+    def setup(self):
+        r"""Sends the options of the connection to the server."""
+        if self.binary is not None:
+            self.sendFormat(self.binary)
+        if self.flushInterval is not None:
+            self.send("flush {0:g}".format(self.flushInterval * 1000))
+            msg = self.recv()
+            self.checkResponse(msg)
+        if self.timestamps:
+            self.send("timestamps")
+            msg = self.recv()
+            self.checkResponse(msg)
+            self.syncClock()
+
+    def resubscribe(self, producer, items, seconds):
+        r"""Called by the receiver thread to reopen a lost connection. The
+        options are sent again, headers fetched again and watching resumed.
+        Full rate clients are resumed with 'history' for the last seconds,
+        which servers keeping a history answer with the samples missed
+        before the live ones; others are watched again. Clients that are no
+        longer EEG clients are not watched anymore. Samples received while
+        resuming are appended to items. Sequence numbers start over if the
+        server was restarted, as told by its start time, or if the header of
+        a client has changed.
+        """
+        self.commandLock.acquire()
+        try:
+            watched = [ cl for cl in sorted(self.clients) if self.isWatching(cl) ]
+            self.watching.clear()
+            if self.socket is not None:
+                self.socket.close()
+            NeuroClient.run(self)
+            self.setup()
+            started = self.syncClock()
+            # without start times, samples may repeat but are not skipped
+            restarted = started is None or started != self.serverStarted
+            if restarted and self.serverStarted is not None:
+                print "Server {0} has been restarted.".format(formatAddress(self.address))
+            roles = dict(self.requestStatus())
+            for cl in watched:
+                if roles.get(cl) != 'EEG':
+                    print "*** Oops! Client #{0} is not EEG device anymore.".format(cl)
+                    self.setWatching(cl, False)
+                    continue
+                header = self.clients[cl][1]
+                self.recvHeader(cl)
+                if header is not None and header.text != self.clients[cl][1].text:
+                    print "Header of client #{0} has changed.".format(cl)
+                    producer.restart(cl)
+                elif restarted:
+                    producer.restart(cl)
+            for cl in watched:
+                if not self.isWatching(cl):
+                    continue
+                rate = self.rates.get(cl)
+                channels = self.channels.get(cl)
+                if rate is None and channels is None:
+                    self.send('history {0} {1:.3f}'.format(cl, seconds))
+                    msg = producer.recvReply(items)
+                    if cmp(msg[0:6], "200 OK") == 0:
+                        try:
+                            first, count = [ int(i) for i in msg.split()[2:4] ]
+                        except ValueError:
+                            raise NeuroError("Unexpected response.")
+                        producer.resume(cl, first, count)
+                        continue
+                self.send(self.watchCommand(cl, rate, channels))
+                self.checkResponse(producer.recvReply(items))
+            self.serverStarted = started
+            if self.isWatchingAny():
+                self.watching.set()
+        finally:
+            self.commandLock.release()
 
     def run(self):
-        NeuroClient.run(self)
-        self.recvStatus()
+        self.commandLock.acquire()
+        try:
+            NeuroClient.run(self)
+            self.setup()
+            if self.reconnect:
+                self.serverStarted = self.syncClock()
+            self.recvStatus()
+        finally:
+            self.commandLock.release()
+
+class Reply(object):
+    r"""Reply to a command of a DisplayConnection, completed by its
+    NeuroDisplayLoop as the response lines arrive. 'extra' is the number of
+    lines following the status line, None if the next line tells it as in
+    the response to 'status'. result() runs the loop until the reply is
+    complete and returns the lines converted by parse, or raises NeuroError
+    for an error response or a lost connection. Functions passed to then()
+    are called with the reply once it is complete.
+    """
+    def __init__(self, loop, command, parse = None, extra = 0):
+        self.loop = loop
+        self.command = command
+        self.parse = parse
+        self.extra = extra
+        self.lines = []
+        self.done = False
+        self.error = None
+        self.value = None
+        self.callbacks = []
+
+    def feed(self, line):
+        r"""Takes the next response line, returns True once complete."""
+        self.lines.append(line)
+        if len(self.lines) == 1 and cmp(line[0:6], "200 OK") != 0:
+            self.finish(NeuroError("Command '{0}' failed: {1}".format(self.command, line)))
+            return True
+        if len(self.lines) == 2 and self.extra is None:
+            m = RE_STATUS.match(line)
+            if m is None:
+                self.finish(NeuroError("Unexpected response."))
+                return True
+            self.extra = 1 + int(m.group(1))
+        if self.extra is not None and len(self.lines) > self.extra:
+            self.finish()
+            return True
+        return False
+
+    def finish(self, error = None):
+        if error is None and self.parse is not None:
+            try:
+                self.value = self.parse(self.lines)
+            except (ValueError, IndexError, NeuroError) as e:
+                error = NeuroError("Unexpected response to '{0}': {1}".format(self.command, e))
+        self.error = error
+        self.done = True
+        for callback in self.callbacks:
+            callback(self)
+        self.callbacks = []
+
+    def then(self, callback):
+        if self.done:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+        return self
+
+    def result(self, timeout = None):
+        self.loop.wait(self, timeout)
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class DisplayConnection(object):
+    r"""Connection of a NeuroDisplayLoop to one server in display role.
+    Commands are sent at once and return Replies, so commands to many
+    servers are in flight together. The SampleBlocks of watched clients are
+    queued per client until taken by stream() or NeuroDisplayLoop.blocks();
+    at most queueSize blocks are kept per client, older ones are dropped
+    and their samples counted in 'drops'.
+    """
+    def __init__(self, loop, address, binary = None, queueSize = DEFAULT_STREAM_BLOCKS):
+        self.loop = loop
+        self.address = address
+        self.binary = binary
+        self.queueSize = queueSize
+        self.clients = {}
+        self.headers = {}
+        self.blocks = {}
+        self.lastSeq = {}
+        self.replies = deque()
+        self.framer = LineFramer()
+        self.socket = None
+        self.closed = False
+        self.drops = 0
+        self.gaps = 0
+
+    def fileno(self):
+        return self.socket.fileno()
 
+    def open(self):
+        try:
+            self.socket = connect(self.address)
+        except socket.error as e:
+            raise NeuroError("Error opening socket: {0}".format(e))
+        self.request('display').then(self.checkReply)
+        if self.binary is not None:
+            self.request('binary ' + self.binary).then(self.checkReply)
+
+    def checkReply(self, reply):
+        if reply.error is not None:
+            print "*** Oops! {0}: {1}".format(formatAddress(self.address), reply.error)
+
+    def request(self, command, parse = None, extra = 0):
+        if self.closed:
+            raise NeuroError("Connection to {0} is closed.".format(formatAddress(self.address)))
+        reply = Reply(self.loop, command, parse, extra)
+        try:
+            self.socket.sendall(command + '\r\n')
+        except socket.error as e:
+            self.close(NeuroError("Error writing socket: {0}".format(e)))
+            raise NeuroError("Error writing socket: {0}".format(e))
+        self.replies.append(reply)
+        return reply
 
+    def status(self):
+        r"""Requests the clients of the server, the Reply gives a dictionary
+        of their roles keyed by client id.
+        """
+        def parse(lines):
+            clients = {}
+            for line in lines[2:]:
+                key, role = line.split(':', 1)
+                clients[int(key)] = role
+            self.clients = clients
+            return clients
+        return self.request('status', parse, None)
+
+    def getHeader(self, client):
+        r"""Requests the Header of client, reduced to the watched channels."""
+        def parse(lines):
+            header = Header(lines[1])
+            self.headers[client] = header
+            return header
+        return self.request('getheader {0}'.format(client), parse, 1)
+
+    def watch(self, client, rate = None, channels = None):
+        r"""Starts receiving samples of client, see NeuroClientDisp.watch().
+        The Reply gives the decimated rate, or None if not decimated.
+        """
+        cmd = 'watch {0}'.format(client)
+        if rate is not None:
+            cmd += ' {0}'.format(rate)
+        if channels is not None:
+            cmd += ' channels ' + ','.join([ str(c) for c in channels ])
+        if client not in self.blocks:
+            self.blocks[client] = deque()
+        def parse(lines):
+            fields = lines[0].split()
+            if len(fields) > 2:
+                return float(fields[2])
+            return None
+        return self.request(cmd, parse)
+
+    def history(self, client, seconds):
+        r"""Starts receiving samples of client like watch(), preceded by
+        those of the last seconds if the server keeps a history. The Reply
+        gives the first sequence number sent and the count of sequence
+        numbers before the live samples.
+        """
+        if client not in self.blocks:
+            self.blocks[client] = deque()
+        def parse(lines):
+            first, count = [ int(i) for i in lines[0].split()[2:4] ]
+            return first, count
+        return self.request('history {0} {1}'.format(client, seconds), parse)
+
+    def unwatch(self, client):
+        self.blocks.pop(client, None)
+        self.lastSeq.pop(client, None)
+        return self.request('unwatch {0}'.format(client))
+
+    def stream(self, client, timeout = None):
+        r"""Yields the SampleBlocks of the watched client as they arrive,
+        running the loop while none is queued. Ends after timeout seconds
+        without a block, raises NeuroError once the connection is lost.
+        """
+        if client not in self.blocks:
+            raise NeuroError("Client #{0} is not watched.".format(client))
+        deadline = None
+        while True:
+            queue = self.blocks.get(client)
+            if queue:
+                deadline = None
+                yield queue.popleft()
+                continue
+            if self.closed:
+                raise NeuroError("Connection to {0} is closed.".format(formatAddress(self.address)))
+            if queue is None:
+                return
+            timeLeft = None
+            if timeout is not None:
+                if deadline is None:
+                    deadline = monotonic() + timeout
+                timeLeft = deadline - monotonic()
+                if timeLeft <= 0:
+                    return
+            self.loop.step(timeLeft)
+
+    def receive(self):
+        try:
+            items = self.framer.recv(self.socket)
+        except socket.error as e:
+            self.close(NeuroError("Error reading socket: {0}".format(e)))
+            return
+        except NeuroError as e:
+            self.close(e)
+            return
+        if items is None:
+            self.close(NeuroError("No more data. Is socket open?"))
+            return
+        run = [] # consecutive '!' lines
+        for item in items:
+            if not isinstance(item, SampleBlock) and item[0:1] == '!':
+                run.append(item)
+                continue
+            if len(run) > 0:
+                self.addBlocks(fromLines(run))
+                run = []
+            if isinstance(item, SampleBlock):
+                self.addBlocks([item])
+            elif item[0:1] == '@':
+                continue
+            elif len(self.replies) > 0:
+                if self.replies[0].feed(item):
+                    self.replies.popleft()
+            else:
+                print "Wrong packet received."
+        if len(run) > 0:
+            self.addBlocks(fromLines(run))
+
+    def addBlocks(self, blocks):
+        for block in blocks:
+            queue = self.blocks.get(block.clId)
+            if queue is None:
+                continue
+            last = self.lastSeq.get(block.clId)
+            self.lastSeq[block.clId] = block.seq + block.count - 1
+            if last is not None and block.seq != last + 1:
+                self.gaps += 1
+                print "Oops! Packet sequence error (client {0}, seq = {1} after {2}).".format(block.clId, block.seq, last)
+            if len(queue) >= self.queueSize:
+                self.drops += queue.popleft().count
+            queue.append(block)
+
+    def close(self, error = None):
+        if self.closed:
+            return
+        self.closed = True
+        if error is not None:
+            print "*** Oops! Connection to {0} lost: {1}".format(formatAddress(self.address), error)
+        self.loop.remove(self)
+        try:
+            self.socket.close()
+        except socket.error:
+            pass
+        if error is None:
+            error = NeuroError("Connection to {0} is closed.".format(formatAddress(self.address)))
+        while self.replies:
+            self.replies.popleft().finish(error)
+
+class NeuroDisplayLoop(object):
+    r"""Display client of any number of servers in a single thread. Every
+    connect() adds a DisplayConnection; one poll over all of them receives
+    replies and samples as step() is called, which Reply.result(),
+    DisplayConnection.stream() and blocks() do while waiting. No thread,
+    queue or event is needed per connection.
+
+        loop = NeuroDisplayLoop()
+        conn = loop.connect(('localhost', 8336))
+        for clId, role in conn.status().result().items():
+            if role == 'EEG':
+                conn.watch(clId)
+        for conn, block in loop.blocks():
+            ...
+    """
+    def __init__(self):
+        self.poller = Poller()
+        self.connections = {}
+
+    def connect(self, address, binary = None, queueSize = DEFAULT_STREAM_BLOCKS):
+        conn = DisplayConnection(self, address, binary, queueSize)
+        conn.open()
+        self.connections[conn.fileno()] = conn
+        self.poller.register(conn.fileno())
+        return conn
+
+    def remove(self, conn):
+        for fd, c in self.connections.items():
+            if c is conn:
+                self.poller.unregister(fd)
+                del self.connections[fd]
+
+    def step(self, timeout = None):
+        r"""Waits at most timeout seconds for data on any connection and
+        handles what has arrived.
+        """
+        if len(self.connections) == 0:
+            raise NeuroError("No open connections.")
+        for fd, readable, writable in self.poller.poll(timeout):
+            conn = self.connections.get(fd)
+            if conn is not None and readable:
+                conn.receive()
+
+    def wait(self, reply, timeout = None):
+        if timeout is not None:
+            deadline = monotonic() + timeout
+        while not reply.done:
+            timeLeft = None
+            if timeout is not None:
+                timeLeft = deadline - monotonic()
+                if timeLeft <= 0:
+                    raise NeuroTimeout("Timeout waiting for reply to '{0}'.".format(reply.command))
+            self.step(timeLeft)
+
+    def blocks(self, timeout = None):
+        r"""Yields (connection, SampleBlock) pairs of all watched clients of
+        all connections as they arrive. Ends after timeout seconds without a
+        block or once no connection is left.
+        """
+        deadline = None
+        while True:
+            found = False
+            for conn in self.connections.values():
+                for queue in conn.blocks.values():
+                    while queue:
+                        found = True
+                        yield conn, queue.popleft()
+            if found:
+                deadline = None
+                continue
+            if len(self.connections) == 0:
+                return
+            timeLeft = None
+            if timeout is not None:
+                if deadline is None:
+                    deadline = monotonic() + timeout
+                timeLeft = deadline - monotonic()
+                if timeLeft <= 0:
+                    return
+            self.step(timeLeft)
 
+    def close(self):
+        for conn in self.connections.values():
+            conn.close()
+        self.poller.close()
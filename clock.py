@@ -0,0 +1,29 @@
+import os
+import time
+import ctypes
+import ctypes.util
+
+CLOCK_MONOTONIC = 1
+
+class timespec(ctypes.Structure):
+    _fields_ = [ ('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long) ]
+
+try:
+    librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno = True)
+    clock_gettime = librt.clock_gettime
+    clock_gettime.argtypes = [ ctypes.c_int, ctypes.POINTER(timespec) ]
+except (OSError, AttributeError, TypeError):
+    clock_gettime = None
+
+def monotonic():
+    r"""Seconds of the system wide monotonic clock, the same in all
+    processes of the host. Falls back to time.time() where the clock is not
+    available.
+    """
+    if clock_gettime is None:
+        return time.time()
+    t = timespec()
+    if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return t.tv_sec + t.tv_nsec * 1e-9
@@ -0,0 +1,84 @@
+from math import sin,cos,pi
+from operator import mul
+
+from pyneuro import Header
+from pyneuro.samples import SampleBlock
+
+# taps of the anti-aliasing filter per unit of the decimation factor
+TAPS_PER_FACTOR = 8
+# pass band edge as a fraction of the Nyquist frequency after decimation
+CUTOFF = 0.8
+
+def lowpass(factor, taps = None):
+    r"""Returns the coefficients of a Hamming windowed sinc low-pass filter
+    for decimation by factor, normalized to unity gain at DC.
+    """
+    if taps is None:
+        taps = TAPS_PER_FACTOR * factor + 1
+    fc = 0.5 * CUTOFF / factor
+    m = (taps - 1) / 2.0
+    h = []
+    for i in range(taps):
+        x = i - m
+        if x == 0:
+            s = 2 * fc
+        else:
+            s = sin(2 * pi * fc * x) / (pi * x)
+        h.append(s * (0.54 - 0.46 * cos(2 * pi * i / (taps - 1))))
+    total = sum(h)
+    return [ v / total for v in h ]
+
+def sourceRate(header):
+    r"""Returns the sampling rate of the first channel of an EDF header
+    string, or None if it cannot be told.
+    """
+    try:
+        header = Header(header)
+        return header.channels[0].samplesCount / float(header.recordDuration)
+    except (ValueError, TypeError, IndexError, ZeroDivisionError):
+        return None
+
+class Decimator(object):
+    r"""Low-pass filters and decimates the samples of one source by an
+    integer factor. The sample with sequence number seq is kept if seq is a
+    multiple of factor and becomes sample seq // factor of the output, so
+    decimated sequence numbers are consecutive again. The filter is causal
+    and delays the signal by (taps - 1) / 2 input samples. Its history is
+    restarted at sequence gaps and changes of the channel count, padded
+    with the first sample.
+    """
+    def __init__(self, factor):
+        self.factor = factor
+        self.taps = lowpass(factor)
+        self.nChannels = None
+        self.history = None
+        self.next = None
+
+    def process(self, block):
+        r"""Returns the decimated SampleBlock of block, or None if no sample
+        of block is kept.
+        """
+        n = block.nChannels
+        values = block.getValues()
+        count = block.count
+        if count == 0:
+            return None
+        length = len(self.taps)
+        if self.next != block.seq or self.nChannels != n:
+            self.nChannels = n
+            self.history = list(values[:n]) * (length - 1)
+        data = self.history + list(values)
+        start = block.seq - (length - 1) # sequence number of data[0]
+        factor = self.factor
+        first = -(-block.seq // factor) * factor
+        taps = self.taps
+        out = []
+        for seq in xrange(first, block.seq + count, factor):
+            i = seq - start - length + 1
+            for c in range(n):
+                out.append(sum(map(mul, taps, data[i*n+c:(i+length)*n:n])))
+        self.history = data[len(data)-(length-1)*n:]
+        self.next = block.seq + count
+        if len(out) == 0:
+            return None
+        return SampleBlock(block.clId, first // factor, n, values = out, time = block.time)
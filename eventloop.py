@@ -0,0 +1,143 @@
+import os
+import errno
+import fcntl
+import select
+
+class Poller(object):
+    r"""Readiness notification for many file descriptors at once.
+    Uses epoll when the platform has it, then poll and finally select, so that
+    thousands of idle connections cost nothing but a registered descriptor.
+    poll() yields (fd, readable, writable) tuples; errors and hangups are
+    reported as readable so that the following recv() sees the condition.
+    """
+    def __init__(self):
+        self.fds = {}
+        if hasattr(select, 'epoll'):
+            self.impl = select.epoll()
+            self.kind = 'epoll'
+            self.IN, self.OUT = select.EPOLLIN, select.EPOLLOUT
+            self.ERR = select.EPOLLERR | select.EPOLLHUP
+        elif hasattr(select, 'poll'):
+            self.impl = select.poll()
+            self.kind = 'poll'
+            self.IN, self.OUT = select.POLLIN, select.POLLOUT
+            self.ERR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+        else:
+            self.impl = None
+            self.kind = 'select'
+            self.IN, self.OUT, self.ERR = 1, 4, 8
+
+    def mask(self, write):
+        if write:
+            return self.IN | self.OUT
+        return self.IN
+
+    def register(self, fd, write = False):
+        self.fds[fd] = write
+        if self.impl is not None:
+            self.impl.register(fd, self.mask(write))
+
+    def modify(self, fd, write):
+        if self.fds.get(fd) == write:
+            return
+        self.fds[fd] = write
+        if self.impl is not None:
+            self.impl.modify(fd, self.mask(write))
+
+    def unregister(self, fd):
+        if fd not in self.fds:
+            return
+        del self.fds[fd]
+        if self.impl is not None:
+            self.impl.unregister(fd)
+
+    def poll(self, timeout = None):
+        try:
+            if self.kind == 'select':
+                w = [ fd for fd,write in self.fds.items() if write ]
+                r, w, x = select.select(self.fds.keys(), w, [], timeout)
+                events = {}
+                for fd in r:
+                    events[fd] = self.IN
+                for fd in w:
+                    events[fd] = events.get(fd, 0) | self.OUT
+                events = events.items()
+            elif self.kind == 'epoll':
+                events = self.impl.poll(-1 if timeout is None else timeout)
+            else:
+                events = self.impl.poll(None if timeout is None else int(timeout*1000))
+        except (select.error, IOError, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        return [ (fd, bool(ev & (self.IN | self.ERR)), bool(ev & self.OUT)) for fd,ev in events ]
+
+    def close(self):
+        if self.kind == 'epoll':
+            self.impl.close()
+        self.fds = {}
+
+class Wakeup(object):
+    r"""Self-pipe used to wake a thread sleeping in Poller.poll() from another thread.
+    Repeated set() calls are collapsed into a single byte until clear() is called.
+    """
+    def __init__(self):
+        self.rfd, self.wfd = os.pipe()
+        for fd in (self.rfd, self.wfd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.pending = False
+
+    def fileno(self):
+        return self.rfd
+
+    def set(self):
+        if self.pending:
+            return
+        self.pending = True
+        try:
+            os.write(self.wfd, 'x')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def clear(self):
+        try:
+            while os.read(self.rfd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        # only after draining: a set() racing with the drain must not leave
+        # 'pending' set with no byte left in the pipe
+        self.pending = False
+
+    def close(self):
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+def wait(readFds, writeFds, timeout = None):
+    r"""One-shot wait for readable readFds or writable writeFds.
+    Meant for short, changing descriptor sets owned by other threads; the
+    sets are not kept between calls, so closed or reused descriptors do no
+    harm. Returns (readable, writable). Descriptors in an error or hangup
+    state are returned as well, so that the following call reports it.
+    """
+    try:
+        if hasattr(select, 'poll'):
+            p = select.poll()
+            for fd in readFds:
+                p.register(fd, select.POLLIN)
+            for fd in writeFds:
+                p.register(fd, select.POLLOUT)
+            events = p.poll(None if timeout is None else int(timeout*1000))
+            readFds = set(readFds)
+            r = [ fd for fd,ev in events if fd in readFds ]
+            w = [ fd for fd,ev in events if fd not in readFds ]
+            return r, w
+        r, w, x = select.select(readFds, writeFds, [], timeout)
+        return r, w
+    except (select.error, IOError, OSError) as e:
+        if e.args[0] == errno.EINTR:
+            return [], []
+        raise
@@ -0,0 +1,346 @@
+#!/usr/bin/python
+
+r"""End-to-end benchmark of NeuroServer on localhost.
+
+Starts a server, synthetic EEG uploaders and displays, each in a process of
+its own, lets them warm up and then measures for the given duration. Every
+display watches every source. The result is printed as one JSON object:
+
+    config   - options of the run
+    upload   - samples per second sent by all uploaders
+    display  - samples per second received by all displays, and the rate
+               expected if nothing was lost
+    latency  - percentiles in seconds per stage: 'display' from acquisition
+               by the server until parsed by a display, 'send' from enqueue
+               until written to the socket, and with --trace the server
+               stages 'read', 'queue' and 'serialize'; None is beyond the
+               last histogram bucket
+    drops    - samples dropped by the server for slow consumers and overruns
+    gaps     - sequence gaps the server saw in uploaded samples
+    cpu      - percent of one core per server thread, and per uploader and
+               display process
+"""
+
+import os
+import sys
+import json
+import ctypes
+import ctypes.util
+import threading
+from threading import Thread,Event
+from multiprocessing import Process,Pipe
+from optparse import OptionParser
+from time import sleep
+
+import pyneuro
+from pyneuro import NeuroDevice,NeuroError
+from pyneuro.header import HEADER
+from pyneuro.server import NeuroServer
+from pyneuro.client import NeuroClientEEG,NeuroClientDisp,NeuroDisplayLoop
+from pyneuro.ring import NeuroDeviceProcess,DEFAULT_HISTORY
+from pyneuro.clock import monotonic
+from pyneuro.stats import Histogram,percentile
+
+PR_SET_NAME = 15
+TICKS = float(os.sysconf('SC_CLK_TCK'))
+PERCENTILES = (0.5, 0.9, 0.99)
+READY_TIMEOUT = 10.0
+RAMP = 1000
+
+class SyntheticDevice(NeuroDevice):
+    r"""Generates a ramp on nChannels channels, paced to rate samples per
+    second in getData() calls of blockSize samples.
+    """
+    def __init__(self, rate, nChannels, blockSize):
+        header = HEADER.copy()
+        header.patient.plain = 'BENCHMARK'
+        header.recording.plain = 'BENCHMARK'
+        header.recordDuration = 1
+        header.channelCount = nChannels
+        header.headBytes = 256 * (nChannels + 1)
+        for i, channel in enumerate(header.channels):
+            channel.label = 'BENCH{0}'.format(i)
+            channel.samplesCount = int(rate)
+            # the ramp is in digital units, so int16 frames can carry it as is
+            channel.physMin, channel.physMax = 0, RAMP
+            channel.digMin, channel.digMax = 0, RAMP
+        NeuroDevice.__init__(self, header.text)
+        self.rate = float(rate)
+        self.nChannels = nChannels
+        self.blockSize = blockSize
+        self.seq = 0
+        self.start = None
+        self.started = Event()
+
+    def getData(self):
+        if self.start is None:
+            self.start = monotonic()
+            self.started.set()
+        delay = self.start + (self.seq + self.blockSize) / self.rate - monotonic()
+        if delay > 0:
+            sleep(delay)
+        n = self.nChannels
+        packets = [ (seq, n) + (seq % RAMP,) * n for seq in range(self.seq, self.seq + self.blockSize) ]
+        self.seq += self.blockSize
+        return packets
+
+class DisplayReader(Thread):
+    def __init__(self, caller, sources):
+        threading.Thread.__init__(self)
+        self.caller = caller
+        self.sources = sources
+        self.samples = 0
+        self.name = "ReaderThread"
+        self.daemon = True
+
+    def run(self):
+        while True:
+            for clId in self.sources:
+                data = self.caller.getData(clId)
+                if len(data) > 0:
+                    self.samples += len(data[0])
+
+class LoopReader(Thread):
+    def __init__(self, loop):
+        threading.Thread.__init__(self)
+        self.loop = loop
+        self.samples = 0
+        self.name = "ReaderThread"
+        self.daemon = True
+
+    def run(self):
+        for conn, block in self.loop.blocks():
+            block.getValues()
+            self.samples += block.count
+
+def nameThreads():
+    r"""Names kernel threads after the Python threads started from now on,
+    so that their CPU time can be told apart in /proc.
+    """
+    try:
+        prctl = ctypes.CDLL(ctypes.util.find_library('c')).prctl
+    except (OSError, AttributeError):
+        return
+    bootstrap = threading.Thread._Thread__bootstrap_inner
+    def named(thread):
+        prctl(PR_SET_NAME, thread.name.replace('Thread', '')[:15], 0, 0, 0)
+        bootstrap(thread)
+    threading.Thread._Thread__bootstrap_inner = named
+    prctl(PR_SET_NAME, 'Main', 0, 0, 0)
+
+def cpuTimes(pid, prefix = ''):
+    r"""Returns CPU seconds used by the live threads of process pid, keyed
+    by 'name/tid'.
+    """
+    times = {}
+    task = '/proc/{0}/task'.format(pid)
+    try:
+        tids = os.listdir(task)
+    except OSError:
+        return times
+    for tid in tids:
+        try:
+            stat = open('{0}/{1}/stat'.format(task, tid)).read()
+        except IOError: # thread has exited
+            continue
+        name = stat[stat.index('(')+1:stat.rindex(')')]
+        fields = stat[stat.rindex(')')+2:].split()
+        times['{0}{1}/{2}'.format(prefix, name, tid)] = (int(fields[11]) + int(fields[12])) / TICKS
+    return times
+
+def startWorker(workers, target, *args):
+    r"""Runs target(connection, *args) in a new process, adds it to workers
+    and waits until it reports to be ready. Workers are not daemonic, the
+    server may need to start device processes of its own.
+    """
+    conn, child = Pipe()
+    process = Process(target = target, args = (child,) + args)
+    process.start()
+    workers.append((process, conn))
+    if not conn.poll(READY_TIMEOUT) or conn.recv() != 'ready':
+        raise NeuroError("Benchmark worker {0} has not started.".format(target.__name__))
+
+def serveReports(conn, report):
+    conn.send('ready')
+    while conn.recv() == 'report':
+        conn.send(report())
+
+def serve(conn, address, options):
+    nameThreads()
+    sys.stdout = open(os.devnull, 'w')
+    devices = [ SyntheticDevice(options.rate, options.channels, options.block) for i in range(options.devices) ]
+    server = NeuroServer(address, devices, eventLoop = options.eventLoop,
+                         processes = options.processes, trace = options.trace,
+                         flushInterval = options.flush / 1000.0, unixPath = options.unix,
+                         history = options.history)
+    server.open()
+    thread = Thread(target = server.run, name = "ServerThread")
+    thread.daemon = True
+    thread.start()
+    def report():
+        stats = server.getStats()
+        cpu = cpuTimes(os.getpid())
+        for clId in stats:
+            sock = server.getSocket(clId)
+            if isinstance(sock,NeuroDeviceProcess):
+                cpu.update(cpuTimes(sock.process.pid, 'DeviceProcess-{0}:'.format(clId)))
+        return { 'stats': stats, 'trace': server.getTrace(), 'cpu': cpu }
+    serveReports(conn, report)
+
+def upload(conn, address, options):
+    nameThreads()
+    sys.stdout = open(os.devnull, 'w')
+    device = SyntheticDevice(options.rate, options.channels, options.block)
+    client = NeuroClientEEG(address, device, options.format, options.window)
+    thread = Thread(target = client.run, name = "UploaderThread")
+    thread.daemon = True
+    thread.start()
+    device.started.wait(READY_TIMEOUT)
+    serveReports(conn, lambda: { 'samples': device.seq, 'cpu': cpuTimes(os.getpid()) })
+
+def display(conn, address, options):
+    nameThreads()
+    sys.stdout = open(os.devnull, 'w')
+    if options.loop:
+        loop = NeuroDisplayLoop()
+        client = loop.connect(address, options.format)
+        for clId, role in sorted(client.status().result().items()):
+            if role == 'EEG':
+                client.watch(clId).result()
+        reader = LoopReader(loop)
+        reader.start()
+        serveReports(conn, lambda: { 'samples': reader.samples,
+                                     'latency': Histogram().items(),
+                                     'cpu': cpuTimes(os.getpid()) })
+        return
+    client = NeuroClientDisp(address, 0, options.format, trace = True, ringSize = options.ring)
+    client.run()
+    sources = [ clId for clId in sorted(client.clients) if client.getRole(clId) == 'EEG' ]
+    for clId in sources:
+        client.watch(clId)
+    reader = DisplayReader(client, sources)
+    reader.start()
+    serveReports(conn, lambda: { 'samples': reader.samples,
+                                 'latency': client.getTrace()['latency'],
+                                 'cpu': cpuTimes(os.getpid()) })
+
+def collect(workers):
+    for process, conn in workers:
+        conn.send('report')
+    return [ conn.recv() for process, conn in workers ]
+
+def histogramDelta(before, after):
+    return [ (bound, count - old) for (bound, count), (b, old) in zip(after, before) ]
+
+def mergeHistograms(histograms):
+    return [ (bound, sum([ h[i][1] for h in histograms ])) for i, (bound, count) in enumerate(histograms[0]) ]
+
+def percentiles(items):
+    return dict([ ('p{0:g}'.format(f*100), percentile(items, f)) for f in PERCENTILES ])
+
+def cpuPercent(before, after, elapsed):
+    return dict([ (key, round(100 * (t - before.get(key, 0.0)) / elapsed, 1)) for key, t in after.items() ])
+
+def processPercent(before, after, elapsed):
+    return round(100 * (sum(after.values()) - sum(before.values())) / elapsed, 1)
+
+def summarize(options, before, after, elapsed):
+    (server0, uploads0, displays0), (server1, uploads1, displays1) = before, after
+    sent = sum([ r['samples'] for r in uploads1 ]) - sum([ r['samples'] for r in uploads0 ])
+    received = sum([ r['samples'] for r in displays1 ]) - sum([ r['samples'] for r in displays0 ])
+    sources = options.uploaders + options.devices
+    latency = {}
+    if options.displays > 0:
+        latency['display'] = percentiles(mergeHistograms([ histogramDelta(b['latency'], a['latency'])
+                                                           for b, a in zip(displays0, displays1) ]))
+    for stage, items in server1['trace'].items():
+        items = histogramDelta(server0['trace'][stage], items)
+        if sum([ count for bound, count in items ]) > 0:
+            latency[stage] = percentiles(items)
+    stats = [ s for s in server1['stats'].values() if s is not None ]
+    return { 'config': vars(options),
+             'elapsed': round(elapsed, 3),
+             'upload': round(sent / elapsed, 1),
+             'display': { 'rate': round(received / elapsed, 1),
+                          'expected': sources * options.rate * options.displays },
+             'latency': latency,
+             'drops': sum([ s['drops'] for s in stats ]),
+             'gaps': sum([ s['gaps'] for s in stats ]),
+             'cpu': { 'server': cpuPercent(server0['cpu'], server1['cpu'], elapsed),
+                      'uploaders': [ processPercent(b['cpu'], a['cpu'], elapsed) for b, a in zip(uploads0, uploads1) ],
+                      'displays': [ processPercent(b['cpu'], a['cpu'], elapsed) for b, a in zip(displays0, displays1) ] } }
+
+def parseArgs(argv):
+    parser = OptionParser(usage = "%prog [<options>]", description = "Benchmarks NeuroServer on localhost "
+                          "and prints throughput, drops, latency percentiles and CPU usage as JSON.")
+    parser.add_option('-u', '--uploaders', type = 'int', default = 2, help = "EEG uploaders [%default]")
+    parser.add_option('-d', '--displays', type = 'int', default = 2, help = "displays watching all sources [%default]")
+    parser.add_option('-s', '--devices', type = 'int', default = 0, help = "synthetic devices of the server [%default]")
+    parser.add_option('-r', '--rate', type = 'int', default = 4000, help = "samples per second per source [%default]")
+    parser.add_option('-c', '--channels', type = 'int', default = 2, help = "channels per source [%default]")
+    parser.add_option('-b', '--block', type = 'int', default = 16, help = "samples per device read [%default]")
+    parser.add_option('-f', '--format', choices = ('text', 'float32', 'int16'), default = 'text',
+                      help = "wire format of uploaders and displays: text, float32 or int16 [%default]")
+    parser.add_option('-w', '--window', type = 'int', default = pyneuro.DEFAULT_WINDOW,
+                      help = "upload window in samples [%default]")
+    parser.add_option('-a', '--acks', action = 'store_true', default = False,
+                      help = "acknowledge every uploaded sample instead of streaming")
+    parser.add_option('-e', '--event-loop', dest = 'eventLoop', action = 'store_true', default = False,
+                      help = "run the server's event loop instead of threads")
+    parser.add_option('-p', '--processes', action = 'store_true', default = False,
+                      help = "read server devices in separate processes")
+    parser.add_option('-F', '--flush', type = 'float', default = 0.0,
+                      help = "milliseconds the server coalesces output to displays [%default]")
+    parser.add_option('-R', '--ring', type = 'int', metavar = 'SIZE',
+                      help = "displays keep samples in ring buffers of SIZE samples")
+    parser.add_option('-L', '--loop', action = 'store_true', default = False,
+                      help = "displays use a single threaded NeuroDisplayLoop")
+    parser.add_option('-H', '--history', type = 'float', default = DEFAULT_HISTORY,
+                      help = "seconds of samples the server keeps per source, 0 for none [%default]")
+    parser.add_option('-T', '--trace', action = 'store_true', default = False, help = "trace server stages")
+    parser.add_option('-t', '--duration', type = 'float', default = 10.0, help = "seconds measured [%default]")
+    parser.add_option('-W', '--warmup', type = 'float', default = 2.0, help = "seconds before measuring [%default]")
+    parser.add_option('-P', '--port', type = 'int', default = pyneuro.DEFAULT_PORT, help = "server port [%default]")
+    parser.add_option('-U', '--unix', metavar = 'PATH', help = "connect the clients through a UNIX domain socket at PATH")
+    options, args = parser.parse_args(argv[1:])
+    if len(args) > 0:
+        parser.error("unexpected arguments")
+    if options.format == 'text':
+        options.format = None
+    if options.acks:
+        options.window = None
+    return options
+
+if __name__ == "__main__":
+    options = parseArgs(sys.argv)
+    address = ('localhost', options.port)
+    clientAddress = address
+    if options.unix is not None:
+        clientAddress = pyneuro.UNIX_PREFIX + options.unix
+    workers = []
+    try:
+        startWorker(workers, serve, address, options)
+        for i in range(options.uploaders):
+            startWorker(workers, upload, clientAddress, options)
+        for i in range(options.displays):
+            startWorker(workers, display, clientAddress, options)
+        sleep(options.warmup)
+        def measure():
+            reports = collect(workers)
+            return reports[0], reports[1:1+options.uploaders], reports[1+options.uploaders:]
+        before = measure()
+        start = monotonic()
+        sleep(options.duration)
+        after = measure()
+        result = summarize(options, before, after, monotonic() - start)
+        print json.dumps(result, sort_keys = True)
+    except NeuroError as err:
+        print >> sys.stderr, "*** Oops! Got error: {0}".format(err)
+        exit(1)
+    except KeyboardInterrupt:
+        print >> sys.stderr, "Shut down on user demand."
+        exit(1)
+    finally:
+        for process, conn in reversed(workers): # clients first, the server last
+            process.terminate()
+            process.join()
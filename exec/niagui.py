@@ -11,6 +11,7 @@ from threading import Semaphore,Thread
 import pyneuro
 from pyneuro import NeuroError
 from pyneuro.client import NeuroClientDisp
+from pyneuro.clock import monotonic
 
 class NIA_Interface():
     """ Attaches the NIA device, and provides low level data collection and information
@@ -18,15 +19,17 @@ class NIA_Interface():
     def __init__(self,address):
         self.address = address
         self.QUEUE_SIZE = 40
+        self.RING_SIZE = 4096
+        self.HISTORY = 20
 
     def open(self) :
         """ Attach NeuroClient 
         """
         try:
             print "Openning connection to neuroserver instance at {0}:{1}.".format(*self.address)
-            self.client = NeuroClientDisp(self.address, self.QUEUE_SIZE)
+            self.client = NeuroClientDisp(self.address, self.QUEUE_SIZE, ringSize = self.RING_SIZE)
             self.client.run()
-            self.client.watch(0)
+            self.client.watch(0, history = self.HISTORY)
         except Exception, err:
             print >> sys.stderr, err
     
@@ -38,21 +41,18 @@ class NIA_Interface():
         except Exception, err:
             print >> sys.stderr, err
     
-    def read(self, points):
-        """ Read data off the NIA from its internal buffer of up to 16 samples
+    def read(self, points, window):
+        """ Wait for new data off the NIA and return the latest window samples
         """
-        data = self.client.getData(0, 10*points)
-        if len(data) > 0:
-            data =  [ (i + 32768) * 256 for i in  data[0] ]
-        else:
-            data = []
-        return data
+        self.client.getData(0, 10*points)
+        return (self.client.getLatest(0, window)[0] + 32768) * 256
         
 class NIA_Data():
     """ Looks after the collection and processing of NIA data
     """
     def __init__(self,point,address) :
         self.Points = point # there is a point every ~5 ms, 
+        self.CALIBRATION_TIMEOUT = 30
         self.Working_Data = []
         self.Hamming = numpy.hamming(256)
         self.interface = NIA_Interface(address)
@@ -64,7 +64,12 @@ class NIA_Data():
         
     def calibrate(self):
         """Perform a NIA Calibration"""
-        for i in range(100):
+        deadline = monotonic() + self.CALIBRATION_TIMEOUT
+        self.record()
+        while len(self.Working_Data) < 3844: # at once if the server keeps enough history
+            if monotonic() > deadline:
+                raise NeuroError("Calibration got {0} of 3844 samples in {1} seconds.".format(
+                    len(self.Working_Data), self.CALIBRATION_TIMEOUT))
             self.record()
         self.Calibration = sum(self.Working_Data)/len(self.Working_Data)
         fourier_stack = numpy.zeros((20,40), dtype=float)
@@ -81,8 +86,7 @@ class NIA_Data():
         samples, about 1.5 percent less than actual, but close enough). 4 extra
         data points are taken for smoothing.
 	    """   
-        current_data = self.interface.read(self.Points)
-        self.Working_Data = (self.Working_Data+current_data)[-3845:-1] 
+        self.Working_Data = self.interface.read(self.Points, 3844)
     
     def process(self):
         """ Process collected data into denoised and Fourier transformed data.
@@ -0,0 +1,67 @@
+from pyneuro import NeuroError
+from pyneuro.samples import MAGIC,parseFrame
+
+DEFAULT_READ_SIZE = 1 << 16
+MAX_LINE = 1 << 20
+
+class LineFramer(object):
+    r"""Incremental receive buffer of one connection.
+    Reads with recv_into() into a bytearray of 'size' bytes and returns
+    complete lines only; an incomplete trailing line is carried over to the
+    next read. Lines are split on '\n', a trailing '\r' is removed.
+    Binary sample frames may be interleaved with lines, they are returned as
+    SampleBlock objects. The bytearray is allocated on the first read unless
+    buffer is given; connections read by a single thread may share one, as
+    only the carried over line is kept per connection.
+    """
+    def __init__(self, size = DEFAULT_READ_SIZE, maxLine = MAX_LINE, buffer = None):
+        self.size = size if buffer is None else len(buffer)
+        self.maxLine = maxLine
+        self.buffer = buffer
+        self.view = None if buffer is None else memoryview(buffer)
+        self.partial = ''
+        self.received = 0
+
+    def recv(self, sock):
+        r"""Reads once from sock and returns the list of completed lines,
+        possibly empty, or None when the peer has closed the connection.
+        Socket errors are left to the caller.
+        """
+        if self.buffer is None:
+            self.buffer = bytearray(self.size)
+            self.view = memoryview(self.buffer)
+        n = sock.recv_into(self.buffer, self.size)
+        if n == 0:
+            return None
+        self.received += n
+        return self.feed(self.view[:n].tobytes())
+
+    def feed(self, data):
+        if len(self.partial) > 0:
+            data = self.partial + data
+        if MAGIC not in data:
+            lines = data.split('\n')
+            self.partial = lines.pop()
+            if len(self.partial) > self.maxLine:
+                raise NeuroError("Line exceeds {0} bytes.".format(self.maxLine))
+            return [ line[:-1] if line.endswith('\r') else line for line in lines ]
+        items = []
+        pos = 0
+        while pos < len(data):
+            if data[pos] == MAGIC:
+                frame = parseFrame(data, pos, self.maxLine)
+                if frame is None:
+                    break
+                block, pos = frame
+                items.append(block)
+            else:
+                end = data.find('\n', pos)
+                if end < 0:
+                    if len(data) - pos > self.maxLine:
+                        raise NeuroError("Line exceeds {0} bytes.".format(self.maxLine))
+                    break
+                line = data[pos:end]
+                items.append(line[:-1] if line.endswith('\r') else line)
+                pos = end + 1
+        self.partial = data[pos:]
+        return items
@@ -37,6 +37,13 @@ MONTHS = ['JAN','FEB','MAR','APR','MAY','JUN','JUL','AUG','SEP','OCT','NOV','DEC
 HEAD_SIZE = 256
 CHANEL_SIZE = 256
 
+def number(s):
+    r"""Parses a numeric header field, EDF allows decimals in some of them."""
+    try:
+        return int(s)
+    except ValueError:
+        return float(s)
+
 class HeaderBase(object):
     def __setattr__(self, name, value):
         if name in [ '__dict__', '_data' ] or '_data' not in self.__dict__:
@@ -72,6 +79,16 @@ class Header(HeaderBase):
         for i in range(head.channelCount):
             head.channels.append(HeaderChannel(self.channels[i]._data.copy(), head))
         return head
+
+    def select(self, channels):
+        r"""Returns a copy of the header with only the channels of the
+        given indices, in that order.
+        """
+        head = self.copy()
+        head.channels = [ HeaderChannel(self.channels[i]._data.copy(), head) for i in channels ]
+        head.channelCount = len(channels)
+        head.headBytes = HEAD_SIZE + len(channels) * CHANEL_SIZE
+        return head
     
     def __init__(self, head = None):
         if head is None:
@@ -116,7 +133,7 @@ class Header(HeaderBase):
             
             self._data['headBytes'] = int(self._data['headBytes'])
             self._data['recordCount'] = int(self._data['recordCount'])
-            self._data['recordDuration'] = int(self._data['recordDuration'])
+            self._data['recordDuration'] = number(self._data['recordDuration'])
             self._data['channelCount'] = int(self._data['channelCount'])
             
             try:
@@ -156,6 +173,11 @@ class Header(HeaderBase):
                     self._data['startDateTime'] = datetime.datetime(y,m,d,*tm)
                 self._data['recording'] = HeaderRecording(p, self)
             
+            if isinstance(self._data['patient'], str):
+                self._data['patient'] = HeaderPatient(self._data['patient'], self)
+            if isinstance(self._data['recording'], str):
+                self._data['recording'] = HeaderRecording(self._data['recording'].strip(), self)
+            
             channels = self._data['channels']
             del self._data['channels']
             r = []
@@ -178,8 +200,8 @@ class Header(HeaderBase):
                 channels2[i]['physDim'] = channels['physDim%s' % i].strip()
                 channels2[i]['prefilter'] = channels['prefilter%s' % i].strip()
                 
-                channels2[i]['physMin'] = int(channels['physMin%s' % i])
-                channels2[i]['physMax'] = int(channels['physMax%s' % i])
+                channels2[i]['physMin'] = number(channels['physMin%s' % i])
+                channels2[i]['physMax'] = number(channels['physMax%s' % i])
                 channels2[i]['digMin'] = int(channels['digMin%s' % i])
                 channels2[i]['digMax'] = int(channels['digMax%s' % i])
                 channels2[i]['samplesCount'] = int(channels['samplesCount%s' % i])
@@ -0,0 +1,145 @@
+from time import time
+from threading import Lock
+from collections import deque
+
+from pyneuro.stats import Histogram
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+DISCONNECT = 'disconnect'
+
+POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+
+DEFAULT_LIMIT = 1 << 20
+DEFAULT_MAX_BEHIND = 10.0
+DEFAULT_FLUSH_SIZE = 1 << 16
+MAX_CHUNK = 1 << 18
+
+class OutputBuffer(object):
+    r"""Bounded queue of outgoing data for one client.
+    Sample packets are pushed as shared strings and are subject to the slow
+    consumer policy once more than 'limit' bytes are queued:
+        drop-oldest - discard queued packets to make room for the new one
+        drop-newest - discard the new packet
+        disconnect  - discard the new packet; the owner is expected to close
+                      the connection once isStalled() reports the oldest
+                      queued data is more than 'maxBehind' seconds old
+    Replies are pushed with droppable set to False and are never dropped.
+    The time from push() until a packet has been completely sent is recorded
+    in the 'latency' histogram, 'sent' counts the bytes written.
+    With 'interval' set, packets are coalesced: dueIn() tells the owner to
+    hold them back until the oldest one is 'interval' seconds old or
+    'threshold' bytes are queued, so they go out in one write. Replies are
+    due at once.
+    """
+    def __init__(self, limit = DEFAULT_LIMIT, policy = DROP_OLDEST, maxBehind = DEFAULT_MAX_BEHIND,
+            interval = 0.0, threshold = DEFAULT_FLUSH_SIZE):
+        if policy not in POLICIES:
+            raise ValueError('Unknown slow consumer policy "{0}".'.format(policy))
+        self.limit = limit
+        self.policy = policy
+        self.maxBehind = maxBehind
+        self.interval = interval
+        self.threshold = threshold
+        self.urgent = 0
+        self.items = deque()
+        self.offset = 0
+        self.size = 0
+        self.drops = 0
+        self.sent = 0
+        self.latency = Histogram()
+        self.lock = Lock()
+
+    def push(self, data, droppable = True):
+        self.lock.acquire()
+        try:
+            if droppable and self.limit > 0 and self.size + len(data) > self.limit:
+                if self.policy == DROP_OLDEST:
+                    self.evict(len(data))
+                if self.size + len(data) > self.limit:
+                    self.drops += 1
+                    return False
+            self.items.append((data, droppable, time()))
+            self.size += len(data)
+            if not droppable:
+                self.urgent += 1
+            return True
+        finally:
+            self.lock.release()
+
+    def evict(self, needed):
+        keep = []
+        if self.offset > 0:
+            keep.append(self.items.popleft())
+        while len(self.items) > 0 and self.size + needed > self.limit:
+            item = self.items.popleft()
+            if item[1]:
+                self.size -= len(item[0])
+                self.drops += 1
+            else:
+                keep.append(item)
+        keep.reverse()
+        self.items.extendleft(keep)
+
+    def behind(self, now = None):
+        if len(self.items) == 0:
+            return 0.0
+        if now is None:
+            now = time()
+        return now - self.items[0][2]
+
+    def isStalled(self, now = None):
+        return self.policy == DISCONNECT and self.behind(now) > self.maxBehind
+
+    def dueIn(self, now = None):
+        r"""Returns the seconds until queued data should be written, 0.0 if
+        it is due now and None if nothing is queued.
+        """
+        if len(self.items) == 0:
+            return None
+        if self.interval <= 0 or self.urgent > 0 or self.offset > 0 or self.size >= self.threshold:
+            return 0.0
+        if now is None:
+            now = time()
+        return max(0.0, self.items[0][2] + self.interval - now)
+
+    def write(self, sock):
+        r"""Writes queued data with a single send() call.
+        Queued items are joined up to MAX_CHUNK bytes, so the socket is
+        never asked twice per readiness notification. Returns True when the
+        buffer has been emptied. Socket errors are left to the caller.
+        """
+        self.lock.acquire()
+        try:
+            if len(self.items) == 0:
+                return True
+            parts = []
+            total = 0
+            for item in self.items:
+                if total > 0 and total + len(item[0]) > MAX_CHUNK:
+                    break
+                parts.append(item[0])
+                total += len(item[0])
+            if self.offset > 0:
+                parts[0] = parts[0][self.offset:]
+            if len(parts) == 1:
+                chunk = parts[0]
+            else:
+                chunk = ''.join(parts)
+            sent = sock.send(chunk)
+            self.size -= sent
+            self.sent += sent
+            sent += self.offset
+            if sent >= len(self.items[0][0]):
+                now = time()
+                while sent > 0 and sent >= len(self.items[0][0]):
+                    data, droppable, queued = self.items.popleft()
+                    sent -= len(data)
+                    if droppable:
+                        self.latency.add(now - queued)
+                    else:
+                        self.urgent -= 1
+            self.offset = sent
+            return len(self.items) == 0
+        finally:
+            self.lock.release()
@@ -0,0 +1,137 @@
+import datetime
+
+import threading
+from threading import Thread
+from Queue import Queue,Full
+
+from pyneuro import NeuroError,Header
+from pyneuro.samples import pack
+
+WRITE_SIZE = 1 << 20
+DEFAULT_RECORD_QUEUE = 1024
+RECORD_COUNT_OFFSET = 236
+
+class EDFRecorder(Thread):
+    r"""Records the sample blocks of one EEG source into an EDF file.
+    put() only queues the block, packing and writing is done by the
+    recorder thread, so recording costs the serving threads one queue put
+    per block. Samples are converted to int16 with the physical and digital
+    ranges of the header and written as whole data records, buffered into
+    writes of about WRITE_SIZE bytes. close() writes the remaining complete
+    records and patches the record count in the header; a trailing partial
+    record is discarded. Blocks that do not fit into the queue of queueSize
+    blocks are dropped and counted in 'drops'. Samples missing from the
+    sequence, dropped or lost upstream, are padded with the last values so
+    that later records keep their time; 'gaps' counts the sequence breaks
+    and 'padded' the samples filled in.
+    """
+    def __init__(self, path, header, queueSize = DEFAULT_RECORD_QUEUE):
+        threading.Thread.__init__(self)
+        if isinstance(header, Header):
+            header = header.copy()
+        else:
+            header = Header(header)
+        self.header = header
+        self.path = path
+        self.nChannels = header.channelCount
+        if self.nChannels < 1:
+            raise NeuroError("Header has no channels.")
+        self.recordSize = header.channels[0].samplesCount
+        self.scales = []
+        for channel in header.channels:
+            if channel.samplesCount != self.recordSize:
+                raise NeuroError("Channels with different sampling rates are not supported.")
+            if channel.physMax == channel.physMin:
+                raise NeuroError("Channel {0} has an empty physical range.".format(channel.label))
+            gain = float(channel.digMax - channel.digMin) / (channel.physMax - channel.physMin)
+            self.scales.append((gain, channel.digMin - channel.physMin * gain, channel.digMin, channel.digMax))
+        header.version = '0'
+        header.startDateTime = datetime.datetime.now()
+        header.headBytes = 256 * (self.nChannels + 1)
+        header.recordCount = -1
+        self.queue = Queue(queueSize)
+        self.values = []
+        self.buffer = []
+        self.buffered = 0
+        self.records = 0
+        self.drops = 0
+        self.gaps = 0
+        self.padded = 0
+        self.next = None
+        self.last = [0.0] * self.nChannels
+        self.file = open(path, 'wb')
+        self.file.write(header.text)
+        self.name = "RecorderThread"
+        self.daemon = True
+
+    def put(self, block):
+        try:
+            self.queue.put_nowait(block)
+        except Full:
+            self.drops += block.count
+
+    def packRecords(self):
+        n = self.nChannels
+        size = self.recordSize * n
+        count = len(self.values) // size
+        for r in range(count):
+            values = self.values[r*size:(r+1)*size]
+            for c in range(n):
+                gain, offset, low, high = self.scales[c]
+                digital = [ min(high, max(low, int(round(v * gain + offset)))) for v in values[c::n] ]
+                self.buffer.append(pack('h', digital))
+                self.buffered += 2 * len(digital)
+        del self.values[:count*size]
+        self.records += count
+
+    def addValues(self, values):
+        self.values.extend(values)
+        if len(self.values) >= self.recordSize * self.nChannels:
+            self.packRecords()
+            if self.buffered >= WRITE_SIZE:
+                self.flush()
+
+    def pad(self, count):
+        r"""Repeats the last values of every channel for count samples."""
+        self.padded += count
+        while count > 0:
+            size = min(count, self.recordSize)
+            self.addValues(self.last * size)
+            count -= size
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.file.write(''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+    def run(self):
+        try:
+            while True:
+                block = self.queue.get()
+                if block is None:
+                    break
+                if block.nChannels != self.nChannels:
+                    print "*** Oops! {0} got block with {1} channels, expected {2}.".format(self.name, block.nChannels, self.nChannels)
+                    continue
+                if self.next is not None and block.seq != self.next:
+                    self.gaps += 1
+                    # a source starting its numbers over cannot be padded
+                    if block.seq > self.next:
+                        self.pad(block.seq - self.next)
+                values = block.getValues()
+                if len(values) == 0:
+                    continue
+                self.addValues(values)
+                self.last = list(values[-self.nChannels:])
+                self.next = block.seq + block.count
+            self.flush()
+            self.file.seek(RECORD_COUNT_OFFSET)
+            self.file.write('{0:<8}'.format(self.records))
+        finally:
+            self.file.close()
+
+    def close(self):
+        r"""Finishes the file and waits for the recorder thread."""
+        self.queue.put(None)
+        self.join()
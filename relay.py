@@ -0,0 +1,166 @@
+import socket
+
+from Queue import Queue,Full,Empty
+
+from pyneuro import NeuroDevice,NeuroDeviceError,formatAddress
+from pyneuro.client import NeuroClientDisp,NeuroSocketProducer
+from pyneuro.samples import SampleBlock,FLOAT32
+from pyneuro.clock import monotonic
+
+DEFAULT_RELAY_QUEUE = 1024
+
+class RelaySource(NeuroDevice):
+    r"""Local EEG client standing in for EEG client 'source' of an upstream
+    server. The relay's receiver thread put()s the upstream blocks, the
+    server takes them with getBlocks(). At most queueSize blocks are kept,
+    older ones are dropped and counted in 'drops' while nobody reads them.
+    """
+    def __init__(self, relay, source, header, queueSize = DEFAULT_RELAY_QUEUE):
+        NeuroDevice.__init__(self, header)
+        self.relay = relay
+        self.source = source
+        self.queue = Queue(queueSize)
+        self.drops = 0
+
+    def put(self, block):
+        while True:
+            try:
+                self.queue.put_nowait(block)
+                return
+            except Full:
+                try:
+                    self.drops += self.queue.get_nowait().count
+                except Empty:
+                    pass
+
+    def getBlocks(self, clId, timeout = 1.0):
+        r"""Waits at most timeout seconds for blocks and returns them as
+        SampleBlocks of the local client clId.
+        """
+        try:
+            blocks = [ self.queue.get(True, timeout) ]
+        except Empty:
+            if not self.relay.provider.isAlive():
+                raise NeuroDeviceError("Connection to upstream server {0} lost.".format(formatAddress(self.relay.address)))
+            return []
+        try:
+            while True:
+                blocks.append(self.queue.get_nowait())
+        except Empty:
+            pass
+        now = monotonic()
+        for block in blocks:
+            block.clId = clId
+            if block.time is None:
+                block.time = now
+        return blocks
+
+    def getData(self):
+        r"""Returns the samples in device packet form."""
+        packets = []
+        for block in self.getBlocks(0):
+            values = block.getValues()
+            n = block.nChannels
+            packets.extend([ tuple([block.seq+i, n] + values[i*n:(i+1)*n]) for i in range(block.count) ])
+        return packets
+
+class RelayReceiver(NeuroSocketProducer):
+    r"""Receiver thread of a NeuroRelay. Instead of splitting samples into
+    channel lists, it hands whole SampleBlocks with their upstream
+    acquisition time to the RelaySource of their client.
+    """
+    def __init__(self, caller):
+        NeuroSocketProducer.__init__(self, caller)
+        self.stamps = {}
+        self.name = "RelayThread"
+
+    def parseSamples(self, lines):
+        blocks = []
+        for line in lines:
+            if isinstance(line, SampleBlock):
+                blocks.append(line)
+            elif line[0:1] == '!':
+                self.parseLine(blocks, line)
+            elif line[0:1] == '@':
+                self.parseStamp(line)
+        for block in blocks:
+            block.time = self.stamps.pop((block.clId, block.seq), None)
+            self.caller.forward(block)
+
+    def parseLine(self, blocks, line):
+        r"""Appends the '!' line to the last of blocks if it continues its
+        samples, otherwise starts a new block.
+        """
+        try:
+            fields = line.split()
+            clId, seq, n = [ int(i) for i in fields[1:4] ]
+            values = [ float(i) for i in fields[4:] ]
+        except ValueError:
+            print "Wrong packet received."
+            return
+        if len(values) != n or n == 0:
+            print "Wrong packet length."
+            return
+        if len(blocks) > 0:
+            block = blocks[-1]
+            if (block.values is not None and block.clId == clId and block.nChannels == n
+                    and block.seq + block.count == seq and (clId, seq) not in self.stamps):
+                block.values.extend(values)
+                return
+        blocks.append(SampleBlock(clId, seq, n, values = values))
+
+    def parseStamp(self, line):
+        try:
+            at, clId, seq, t = line.split()
+            self.stamps[(int(clId), int(seq))] = float(t) - self.caller.clockOffset
+        except ValueError:
+            print "Wrong timestamp received."
+
+    def enqueueSamples(self):
+        pass
+
+class NeuroRelay(NeuroClientDisp):
+    r"""Display client mirroring the EEG clients of an upstream server.
+    run() connects, fetches the upstream clients and their headers and
+    creates a RelaySource for every EEG client, which a NeuroServer serves
+    as local EEG clients; watchAll() then subscribes to each of them once.
+    Samples are requested as binary frames of format binary (None for
+    text), which are forwarded to local watchers of that format as they
+    are. Acquisition times are kept, converted to the local clock.
+    EEG clients connecting upstream later are not mirrored, and a lost
+    upstream connection is not reopened.
+    """
+    Producer = RelayReceiver
+
+    def __init__(self, address, binary = FLOAT32, queueSize = DEFAULT_RELAY_QUEUE):
+        NeuroClientDisp.__init__(self, address, 0, binary, timestamps = True, reconnect = False)
+        self.sourceQueueSize = queueSize
+        self.sources = {}
+
+    def run(self):
+        NeuroClientDisp.run(self)
+        for clId in sorted(self.clients):
+            if self.getRole(clId) == 'EEG':
+                self.sources[clId] = RelaySource(self, clId, self.getHeader(clId).text, self.sourceQueueSize)
+        print "Relaying {0} EEG clients of {1}.".format(len(self.sources), formatAddress(self.address))
+
+    def getSources(self):
+        return [ self.sources[clId] for clId in sorted(self.sources) ]
+
+    def watchAll(self):
+        for clId in sorted(self.sources):
+            self.watch(clId)
+
+    def forward(self, block):
+        source = self.sources.get(block.clId)
+        if source is not None:
+            source.put(block)
+
+    def close(self):
+        self.terminate.set()
+        self.watching.set()
+        if self.socket is not None:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
@@ -0,0 +1,132 @@
+import mmap
+from time import sleep
+
+from pyneuro import NeuroDevice,NeuroDeviceError,Header
+from pyneuro.header import HEADER
+from pyneuro.samples import unpack
+from pyneuro.clock import monotonic
+
+DEFAULT_BLOCK = 16
+
+class ReplayDevice(NeuroDevice):
+    r"""Device playing back a recording, an EDF file or a raw .npy array of
+    shape (samples, channels) which needs 'rate' (and optionally 'header').
+    The file is memory mapped, so several instances may replay large files
+    at once. speed is a multiple of the recorded sampling rate, None or 0
+    replays as fast as the server reads. With loop set, playback restarts at
+    the end of the recording, otherwise getData() raises NeuroDeviceError.
+    Sequence numbers keep increasing across loops.
+    """
+    def __init__(self, path, speed = 1.0, loop = False, blockSize = DEFAULT_BLOCK, rate = None, header = None):
+        if path.endswith('.npy'):
+            self.openNpy(path, rate, header)
+        else:
+            self.openEDF(path)
+        NeuroDevice.__init__(self, self.header)
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.blockSize = blockSize
+        self.position = 0
+        self.seq = 0
+        self.sent = 0
+        self.start = None
+
+    def openEDF(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            headBytes = int(self.map[184:192])
+            header = Header(self.map[:headBytes])
+        except ValueError:
+            raise NeuroDeviceError("{0} is not a valid EDF file.".format(path))
+        self.nChannels = header.channelCount
+        self.recordSize = header.channels[0].samplesCount
+        self.scales = []
+        for channel in header.channels:
+            if channel.samplesCount != self.recordSize:
+                raise NeuroDeviceError("Channels with different sampling rates are not supported.")
+            gain = float(channel.physMax - channel.physMin) / (channel.digMax - channel.digMin)
+            self.scales.append((gain, channel.physMin - channel.digMin * gain))
+        self.headBytes = headBytes
+        self.recordBytes = 2 * self.nChannels * self.recordSize
+        self.count = (len(self.map) - headBytes) // self.recordBytes * self.recordSize
+        self.rate = self.recordSize / float(header.recordDuration)
+        self.header = self.map[:headBytes]
+        self.record = None
+        self.rows = []
+        self.read = self.readEDF
+
+    def openNpy(self, path, rate, header):
+        try:
+            import numpy
+        except ImportError:
+            raise NeuroDeviceError("numpy is required to replay .npy files.")
+        if rate is None:
+            raise NeuroDeviceError("Sampling rate of {0} is required.".format(path))
+        data = numpy.load(path, mmap_mode = 'r')
+        if data.ndim == 1:
+            data = data.reshape((-1, 1))
+        self.data = data
+        self.count, self.nChannels = data.shape
+        self.rate = float(rate)
+        if header is None:
+            header = HEADER.copy()
+            header.patient.plain = 'REPLAY'
+            header.recording.plain = path[-80:]
+            header.recordDuration = 1
+            header.channelCount = self.nChannels
+            header.headBytes = 256 * (self.nChannels + 1)
+            low, high = int(numpy.floor(data.min())), int(numpy.ceil(data.max()))
+            for i, channel in enumerate(header.channels):
+                channel.label = 'REPLAY{0}'.format(i)
+                channel.samplesCount = int(rate)
+                channel.physMin, channel.physMax = low, max(high, low + 1)
+                channel.digMin, channel.digMax = -32768, 32767
+            header = header.text
+        self.header = header
+        self.read = self.readNpy
+
+    def readEDF(self, start, count):
+        rows = []
+        while count > 0:
+            r, i = divmod(start, self.recordSize)
+            if self.record != r:
+                offset = self.headBytes + r * self.recordBytes
+                digital = unpack('h', self.map[offset:offset+self.recordBytes])
+                n = self.recordSize
+                channels = [ [ d * gain + shift for d in digital[c*n:(c+1)*n] ]
+                             for c,(gain,shift) in enumerate(self.scales) ]
+                self.rows = zip(*channels)
+                self.record = r
+            take = min(count, self.recordSize - i)
+            rows.extend(self.rows[i:i+take])
+            start += take
+            count -= take
+        return rows
+
+    def readNpy(self, start, count):
+        return self.data[start:start+count].tolist()
+
+    def getHeader(self):
+        return self.header
+
+    def getData(self):
+        if self.start is None:
+            self.start = monotonic()
+        count = self.blockSize
+        if self.speed:
+            delay = self.start + (self.sent + count) / (self.rate * self.speed) - monotonic()
+            if delay > 0:
+                sleep(delay)
+        if self.position >= self.count:
+            if not self.loop or self.count == 0:
+                raise NeuroDeviceError("End of recording {0}.".format(self.path))
+            self.position = 0
+        count = min(count, self.count - self.position)
+        n = self.nChannels
+        packets = [ (self.seq+i, n) + tuple(row) for i,row in enumerate(self.read(self.position, count)) ]
+        self.position += count
+        self.seq += count
+        self.sent += count
+        return packets
@@ -0,0 +1,338 @@
+import os
+import errno
+import fcntl
+from array import array
+from threading import Condition
+from collections import deque
+from multiprocessing import Process,RawArray,RawValue
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from pyneuro import NeuroError,NeuroDevice,NeuroDeviceError,Header
+from pyneuro.clock import monotonic
+from pyneuro.eventloop import wait
+from pyneuro.samples import SampleBlock,CODES,unpack
+
+DEFAULT_RING_SIZE = 1 << 16
+DEFAULT_CHANNEL_RING_SIZE = 1 << 14
+# no history unless asked for: a source with a history is read even while unwatched
+DEFAULT_HISTORY = 0.0
+
+class SampleRing(object):
+    r"""Ring of samples in shared memory with one writer and one reader.
+    The writer, usually another process, first advances 'writing' to the
+    number of samples written once it is done, stores sequence numbers and
+    values of nChannels channels into the slots and then advances 'head',
+    the number of samples ever written. The reader keeps its own 'tail'; if
+    it falls more than 'capacity' samples behind, the oldest samples are
+    lost and counted in 'overruns'. After copying, the reader discards the
+    slots 'writing' tells may have been overwritten meanwhile, like a
+    seqlock. A pipe wakes the reader after each write. Each write is
+    stamped with the monotonic time it was made.
+    """
+    def __init__(self, nChannels, capacity = DEFAULT_RING_SIZE):
+        self.nChannels = nChannels
+        self.capacity = capacity
+        self.seqs = RawArray('L', capacity)
+        self.times = RawArray('d', capacity)
+        self.values = RawArray('d', capacity * nChannels)
+        self.head = RawValue('L', 0)
+        self.writing = RawValue('L', 0)
+        self.tail = 0
+        self.overruns = 0
+        self.views = None
+        self.rfd, self.wfd = os.pipe()
+        for fd in (self.rfd, self.wfd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self.rfd
+
+    def put(self, packets):
+        r"""Writer side: stores device packets (seq, nChannels, values...)."""
+        n = self.nChannels
+        head = self.head.value
+        now = monotonic()
+        self.writing.value = head + len(packets)
+        for packet in packets:
+            if packet[1] != n or len(packet) != n + 2:
+                raise NeuroDeviceError("Packet size not consistent.")
+            slot = head % self.capacity
+            self.seqs[slot] = packet[0]
+            self.times[slot] = now
+            self.values[slot*n:(slot+1)*n] = packet[2:]
+            head += 1
+        self.head.value = head
+        try:
+            os.write(self.wfd, 'x')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def clear(self):
+        try:
+            while os.read(self.rfd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def getViews(self):
+        r"""Returns numpy arrays over the memory of seqs, times and values,
+        made by the reader on first use.
+        """
+        if self.views is None:
+            self.views = (numpy.frombuffer(self.seqs, dtype = numpy.uint),
+                          numpy.frombuffer(self.times, dtype = float),
+                          numpy.frombuffer(self.values, dtype = float))
+        return self.views
+
+    def get(self, clId):
+        r"""Reader side: returns the samples written since the last call as
+        SampleBlocks of clId, a new block is started at every sequence gap.
+        If numpy is available the slots are copied through numpy views and
+        the blocks carry (samples, channels) arrays, lists otherwise.
+        """
+        n = self.nChannels
+        head = self.head.value
+        tail = self.tail
+        if head - tail > self.capacity:
+            self.overruns += head - tail - self.capacity
+            tail = head - self.capacity
+        self.tail = head
+        if head == tail:
+            return []
+        start = tail % self.capacity
+        first = min(self.capacity - start, head - tail)
+        rest = head - tail - first
+        if numpy is not None:
+            seqView, timeView, valueView = self.getViews()
+            seqs = numpy.concatenate((seqView[start:start+first], seqView[0:rest]))
+            times = numpy.concatenate((timeView[start:start+first], timeView[0:rest]))
+            values = numpy.concatenate((valueView[start*n:(start+first)*n], valueView[0:rest*n]))
+        else:
+            seqs = self.seqs[start:start+first]
+            times = self.times[start:start+first]
+            values = self.values[start*n:(start+first)*n]
+            if rest > 0:
+                seqs.extend(self.seqs[0:rest])
+                times.extend(self.times[0:rest])
+                values.extend(self.values[0:rest*n])
+        # slots the writer may have overwritten while being copied are discarded
+        lost = self.writing.value - self.capacity - tail
+        if lost > 0:
+            lost = min(lost, len(seqs))
+            self.overruns += lost
+            seqs = seqs[lost:]
+            times = times[lost:]
+            values = values[lost*n:]
+        if len(seqs) == 0:
+            return []
+        blocks = []
+        begin = 0
+        if numpy is not None:
+            values = values.reshape(-1, n)
+            for end in (numpy.flatnonzero(numpy.diff(seqs) != 1) + 1).tolist() + [len(seqs)]:
+                blocks.append(SampleBlock(clId, int(seqs[begin]), n, array = values[begin:end],
+                                          time = float(times[begin])))
+                begin = end
+            return blocks
+        ends = [ i for i in range(1, len(seqs)) if seqs[i] != seqs[i-1] + 1 ]
+        for end in ends + [len(seqs)]:
+            blocks.append(SampleBlock(clId, seqs[begin], n, values = values[begin*n:end*n], time = times[begin]))
+            begin = end
+        return blocks
+
+class ChannelRing(object):
+    r"""Latest 'capacity' samples of one source, kept per channel in a
+    preallocated numpy array of nChannels rows. Every sample is stored twice,
+    capacity slots apart, so any run of the latest samples is contiguous and
+    is returned as a (channels, samples) view without copying. 'head' counts
+    the samples ever put and serves as cursor. A view stays valid until
+    capacity minus its length more samples are put; copy it to keep it
+    longer. One thread puts, any thread reads.
+    """
+    def __init__(self, nChannels, capacity = DEFAULT_CHANNEL_RING_SIZE):
+        if numpy is None:
+            raise NeuroError("numpy is required for ring buffers.")
+        self.nChannels = nChannels
+        self.capacity = capacity
+        self.data = numpy.zeros((nChannels, 2 * capacity))
+        self.head = 0
+        self.cond = Condition()
+
+    def put(self, columns):
+        r"""Stores samples given as one row (or list) per channel."""
+        columns = numpy.asarray(columns, dtype = float)
+        if columns.ndim != 2 or columns.shape[0] != self.nChannels:
+            raise NeuroError("Wrong packet length.")
+        cap = self.capacity
+        head = self.head
+        count = columns.shape[1]
+        if count > cap:
+            head += count - cap
+            columns = columns[:,count-cap:]
+            count = cap
+        start = head % cap
+        first = min(cap - start, count)
+        self.data[:,start:start+first] = columns[:,:first]
+        self.data[:,start+cap:start+cap+first] = columns[:,:first]
+        rest = count - first
+        if rest > 0:
+            self.data[:,0:rest] = columns[:,first:]
+            self.data[:,cap:cap+rest] = columns[:,first:]
+        self.cond.acquire()
+        try:
+            self.head = head + count
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def view(self, first, last):
+        r"""Returns the samples first to last - 1 (counted like head), which
+        must be among the latest capacity ones.
+        """
+        start = first % self.capacity
+        return self.data[:,start:start+last-first]
+
+    def getLatest(self, count):
+        r"""Returns the latest count samples, fewer if not put yet."""
+        head = self.head
+        return self.view(head - min(count, head, self.capacity), head)
+
+    def getSince(self, cursor, minLength = 0, timeout = None):
+        r"""Waits at most timeout seconds for minLength samples after cursor.
+        Returns (samples, cursor): the samples put since cursor, at most
+        capacity of them, and the cursor to pass next time. A cursor ahead
+        of head, e.g. of a replaced ring, starts from the oldest sample.
+        """
+        self.cond.acquire()
+        try:
+            if cursor > self.head:
+                cursor = 0
+            minLength = min(minLength, self.capacity)
+            if timeout is not None:
+                deadline = monotonic() + timeout
+            while self.head - cursor < minLength:
+                if timeout is None:
+                    self.cond.wait()
+                    continue
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            head = self.head
+        finally:
+            self.cond.release()
+        return self.view(max(cursor, head - self.capacity), head), head
+
+class HistoryRing(object):
+    r"""Samples of one source of the last 'seconds' seconds, kept as
+    (time, seq, nChannels, values) entries per block with the values in an
+    array, of the type of binary frames for blocks received as one, the
+    numpy array of blocks read from a SampleRing, of doubles otherwise; not
+    as SampleBlocks with their encodings. 'next' is the sequence number
+    following the last samples put, None before any.
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.entries = deque()
+        self.next = None
+
+    def put(self, block, now):
+        t = now if block.time is None else block.time
+        if block.array is not None:
+            values = block.array
+        elif block.values is None and block.payload is not None:
+            values = unpack(CODES[block.code][1], block.payload)
+        else:
+            values = array('d', block.getValues())
+        self.entries.append((t, block.seq, block.nChannels, values))
+        self.next = block.seq + block.count
+        limit = now - self.seconds
+        # a block older than the history itself is dropped as well
+        while len(self.entries) > 0 and self.entries[0][0] < limit:
+            self.entries.popleft()
+
+    def get(self, clId, seconds, now):
+        r"""Returns the samples of the last seconds as SampleBlocks of clId."""
+        limit = now - min(seconds, self.seconds)
+        blocks = []
+        for t, seq, n, values in self.entries:
+            if t < limit:
+                continue
+            if isinstance(values, array):
+                blocks.append(SampleBlock(clId, seq, n, values = values.tolist(), time = t))
+            else:
+                blocks.append(SampleBlock(clId, seq, n, array = values, time = t))
+        return blocks
+
+class NeuroDeviceProcess(NeuroDevice):
+    r"""Runs the getData() loop of device in a separate process.
+    Samples are passed to the server through a SampleRing, so reading and
+    decoding the device does not compete with socket fan-out for the GIL.
+    The process is forked, the device must not need anything that lives in
+    threads of the server process (like TriggerDevice does).
+    """
+    def __init__(self, device, capacity = DEFAULT_RING_SIZE):
+        header = device.getHeader()
+        NeuroDevice.__init__(self, header)
+        self.device = device
+        self.ring = SampleRing(Header(header).channelCount, capacity)
+        self.process = None
+        self.lostReported = 0
+
+    def start(self, inherited = ()):
+        r"""Starts the device process. Sockets listed in inherited are
+        closed in the child so it does not keep them open.
+        """
+        self.process = Process(target = self.produce, args = (inherited,))
+        self.process.daemon = True
+        self.process.start()
+
+    def produce(self, inherited):
+        for sock in inherited:
+            if sock is not None:
+                sock.close()
+        parent = os.getppid()
+        try:
+            while os.getppid() == parent: # exit with the server
+                self.ring.put(self.device.getData())
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            print "*** Oops! Device process {0} got: {1}".format(os.getpid(), e)
+
+    def getData(self):
+        r"""Returns the samples in device packet form."""
+        packets = []
+        for block in self.getBlocks(0):
+            values = block.getValues()
+            n = block.nChannels
+            packets.extend([ tuple([block.seq+i, n] + values[i*n:(i+1)*n]) for i in range(block.count) ])
+        return packets
+
+    def getBlocks(self, clId, timeout = 1.0):
+        r"""Waits at most timeout seconds for samples and returns them as
+        SampleBlocks of clId.
+        """
+        blocks = self.ring.get(clId)
+        if len(blocks) == 0:
+            r, w = wait([self.ring.fileno()], [], timeout)
+            self.ring.clear()
+            blocks = self.ring.get(clId)
+        if self.ring.overruns > self.lostReported:
+            print "Device ring overrun, {0} samples lost.".format(self.ring.overruns - self.lostReported)
+            self.lostReported = self.ring.overruns
+        if len(blocks) == 0 and not self.process.is_alive():
+            raise NeuroDeviceError("Device process has terminated.")
+        return blocks
+
+    def close(self):
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
@@ -0,0 +1,289 @@
+import sys
+import struct
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from pyneuro import NeuroError,Header
+
+TEXT = 'text'
+FLOAT32 = 'float32'
+INT16 = 'int16'
+
+## Binary sample frames
+# A frame starts with MAGIC, which never starts a line of the text protocol,
+# followed by the rest of FRAME and the packed values, sample after sample:
+#     magic, format code, client id, start sequence, sample count, channel count
+MAGIC = '\xfe'
+FRAME = struct.Struct('<cBIIHH')
+BINARY = { FLOAT32: (1, 'f'), INT16: (2, 'h') }
+CODES = dict( (code, (name, typecode)) for name,(code,typecode) in BINARY.items() )
+FRAME_ITEMSIZE = dict( (code, array(typecode).itemsize) for code,(name,typecode) in CODES.items() )
+MAX_FRAME_SAMPLES = 0xffff
+
+INT16_MIN = -32768
+INT16_MAX = 32767
+
+def pack(typecode, values):
+    a = array(typecode, values)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a.tostring()
+
+def unpack(typecode, payload):
+    a = array(typecode)
+    a.fromstring(payload)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a
+
+def toInt16(values):
+    return [ min(INT16_MAX, max(INT16_MIN, int(round(v)))) for v in values ]
+
+def arrayToInt16(values):
+    r"""toInt16() of a numpy array, rounding halves away from zero too."""
+    rounded = numpy.sign(values) * numpy.floor(numpy.abs(values) + 0.5)
+    return numpy.clip(rounded, INT16_MIN, INT16_MAX).astype('<i2')
+
+def fitsInt16(header):
+    r"""Tells whether samples of a source with the EDF header (a Header or
+    its string) can be sent as int16 frames. Their values are not scaled,
+    so the physical range of every channel must equal its digital range,
+    within the int16 range.
+    """
+    try:
+        if not isinstance(header, Header):
+            header = Header(header)
+        for channel in header.channels:
+            if (channel.physMin != channel.digMin or channel.physMax != channel.digMax
+                    or channel.digMin < INT16_MIN or channel.digMax > INT16_MAX):
+                return False
+    except (ValueError, TypeError):
+        return False
+    return True
+
+class SampleBlock(object):
+    r"""Consecutive samples of one source, starting at sequence number seq.
+    A block is created from text '!' lines, from numeric values (sample after
+    sample), from a (samples, channels) numpy array or from the payload of a
+    binary frame, and renders the other representations on demand. encode()
+    caches its result per format, so a block is serialized at most once per
+    format however many watchers get it. time is the acquisition time of the
+    block on the monotonic clock.
+    """
+    def __init__(self, clId, seq, nChannels, values = None, lines = None, payload = None, code = None, time = None,
+            array = None):
+        self.clId = clId
+        self.seq = seq
+        self.nChannels = nChannels
+        self.time = time
+        self.values = values
+        self.array = array
+        self.lines = lines
+        self.payload = payload
+        self.code = code
+        self.encoded = {}
+
+    @property
+    def count(self):
+        if self.lines is not None:
+            return len(self.lines)
+        if self.values is not None:
+            return len(self.values) // self.nChannels
+        if self.array is not None:
+            return len(self.array)
+        return len(self.payload) // (FRAME_ITEMSIZE[self.code] * self.nChannels)
+
+    def getValues(self):
+        if self.values is None:
+            if self.array is not None:
+                self.values = self.array.ravel().tolist()
+            elif self.payload is not None:
+                self.values = unpack(CODES[self.code][1], self.payload).tolist()
+            else:
+                values = []
+                for line in self.lines:
+                    values.extend([ float(i) for i in line.split()[4:] ])
+                self.values = values
+        return self.values
+
+    def getArray(self):
+        r"""Returns the samples as a (samples, channels) numpy array, a view
+        of the payload of binary blocks.
+        """
+        if self.array is not None:
+            return self.array
+        if self.values is None and self.payload is not None:
+            values = numpy.frombuffer(self.payload, numpy.dtype(CODES[self.code][1]).newbyteorder('<'))
+        else:
+            values = numpy.array(self.getValues(), dtype = float)
+        return values.reshape(-1, self.nChannels)
+
+    def select(self, channels):
+        r"""Returns a block of the given channels only, in that order, or
+        None if the block has fewer channels.
+        """
+        n = self.nChannels
+        if max(channels) >= n:
+            return None
+        if self.array is not None:
+            return SampleBlock(self.clId, self.seq, len(channels), array = self.array[:,list(channels)], time = self.time)
+        values = self.getValues()
+        columns = [ values[c::n] for c in channels ]
+        if len(columns) == 1:
+            values = columns[0]
+        else:
+            values = [ v for sample in zip(*columns) for v in sample ]
+        return SampleBlock(self.clId, self.seq, len(channels), values = values, time = self.time)
+
+    def getLines(self):
+        if self.lines is None:
+            n = self.nChannels
+            if self.payload is not None and CODES[self.code][0] == FLOAT32:
+                fmt = "! {0} {1} {2}" + "".join([ " {"+str(i+3)+":.7g}" for i in range(n) ])
+            else:
+                fmt = "! {0} {1} {2}" + "".join([ " {"+str(i+3)+"}" for i in range(n) ])
+            values = self.getValues()
+            self.lines = [ fmt.format(self.clId, self.seq+i, n, *values[i*n:(i+1)*n]) for i in range(self.count) ]
+        return self.lines
+
+    def getPayload(self, code):
+        if self.payload is not None and self.code == code:
+            return self.payload
+        name, typecode = CODES[code]
+        if self.array is not None:
+            if name == INT16:
+                return arrayToInt16(self.array).tostring()
+            return self.array.astype('<' + typecode).tostring()
+        values = self.getValues()
+        if name == INT16:
+            values = toInt16(values)
+        return pack(typecode, values)
+
+    def encode(self, fmt = TEXT, stamped = False):
+        r"""Returns the block in wire format fmt. If stamped, the block is
+        preceded by the line "@ <client id> <seq> <acquisition time>".
+        """
+        key = fmt
+        if stamped and self.time is not None:
+            key = fmt + '@'
+        data = self.encoded.get(key)
+        if data is not None:
+            return data
+        if key != fmt:
+            data = "@ {0} {1} {2:.6f}\r\n".format(self.clId, self.seq, self.time) + self.encode(fmt)
+        elif fmt == TEXT:
+            data = '\r\n'.join(self.getLines()) + '\r\n'
+        else:
+            code = BINARY[fmt][0]
+            payload = self.getPayload(code)
+            count = self.count
+            step = MAX_FRAME_SAMPLES * self.nChannels * FRAME_ITEMSIZE[code]
+            frames = []
+            for i in range(0, count, MAX_FRAME_SAMPLES):
+                n = min(MAX_FRAME_SAMPLES, count - i)
+                offset = (i // MAX_FRAME_SAMPLES) * step
+                frames.append(FRAME.pack(MAGIC, code, self.clId, self.seq + i, n, self.nChannels))
+                frames.append(payload[offset:offset+step])
+            data = ''.join(frames)
+        self.encoded[key] = data
+        return data
+
+def fromPackets(clId, packets):
+    r"""Groups device packets (seq, nChannels, values...) into SampleBlocks,
+    starting a new block at every sequence gap or change of channel count.
+    """
+    blocks = []
+    block = None
+    for packet in packets:
+        if packet[1] + 2 != len(packet):
+            raise NeuroError("Packet size not consistent.")
+        if block is None or block.nChannels != packet[1] or block.seq + block.count != packet[0]:
+            block = SampleBlock(clId, packet[0], packet[1], values = [])
+            blocks.append(block)
+        block.values.extend(packet[2:])
+    return blocks
+
+def fromLines(lines):
+    r"""Groups text '!' lines into SampleBlocks, starting a new block at
+    every change of client or channel count and at every sequence gap. Only
+    the ids are parsed here, the values once the block is asked for them.
+    """
+    blocks = []
+    block = None
+    for line in lines:
+        try:
+            clId, seq, n = [ int(i) for i in line.split(None, 4)[1:4] ]
+        except ValueError:
+            print "Wrong packet received."
+            continue
+        if block is None or block.clId != clId or block.nChannels != n or block.seq + len(block.lines) != seq:
+            block = SampleBlock(clId, seq, n, lines = [])
+            blocks.append(block)
+        block.lines.append(line)
+    return blocks
+
+def parseLines(lines):
+    r"""Parses text '!' lines in one pass into (clId, seq, values) blocks,
+    values being a (samples, channels) numpy array. A new block starts at
+    every change of client or channel count and at every sequence gap.
+    Returns None if numpy is not available or a line is malformed.
+    """
+    if numpy is None or len(lines) == 0:
+        return None
+    try:
+        flat = numpy.fromstring(' '.join([ line[1:] for line in lines ]), sep = ' ')
+        n = int(flat[2])
+    except (ValueError, IndexError):
+        return None
+    if flat.size == len(lines) * (n + 3):
+        groups = [ flat.reshape(len(lines), n + 3) ]
+    else:
+        # channel counts differ, reshape runs of lines of equal width
+        groups = []
+        pos = 0
+        start = 0
+        width = None
+        for i in xrange(len(lines)):
+            if pos + 2 >= flat.size:
+                return None
+            w = int(flat[pos+2]) + 3
+            if w != width and width is not None:
+                groups.append(flat[start:pos].reshape(-1, width))
+                start = pos
+            width = w
+            pos += w
+        if pos != flat.size:
+            return None
+        groups.append(flat[start:pos].reshape(-1, width))
+    blocks = []
+    for rows in groups:
+        if (rows[:,2] != rows.shape[1] - 3).any() or rows.shape[1] == 3:
+            return None
+        ids = rows[:,0].astype(int)
+        seqs = rows[:,1].astype(int)
+        breaks = numpy.flatnonzero((ids[1:] != ids[:-1]) | (seqs[1:] != seqs[:-1] + 1)) + 1
+        bounds = [0] + breaks.tolist() + [len(rows)]
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            blocks.append((int(ids[start]), int(seqs[start]), rows[start:end,3:]))
+    return blocks
+
+def parseFrame(data, pos, maxSize):
+    r"""Decodes the binary frame starting at data[pos].
+    Returns (block, end) or None if the frame is not complete yet.
+    """
+    if len(data) - pos < FRAME.size:
+        return None
+    magic, code, clId, seq, count, nChannels = FRAME.unpack_from(data, pos)
+    if code not in CODES or nChannels == 0:
+        raise NeuroError("Malformed binary frame.")
+    size = count * nChannels * FRAME_ITEMSIZE[code]
+    if size > maxSize:
+        raise NeuroError("Binary frame exceeds {0} bytes.".format(maxSize))
+    start = pos + FRAME.size
+    if len(data) - start < size:
+        return None
+    return SampleBlock(clId, seq, nChannels, payload = data[start:start+size], code = code), start + size
@@ -1,15 +1,45 @@
 
 import re
+import os
+import stat
+import datetime
 
+import errno
 import socket
 
 import threading
-from threading import Thread,Lock,Event,RLock
+from threading import Thread,Lock,Event,RLock,Condition
 from Queue import Queue,Full,Empty
 
-from time import sleep
+from time import sleep,time
 
-from pyneuro import NeuroError,NeuroTimeout,Neuro,NeuroDevice
+from collections import deque
+
+from pyneuro import NeuroError,NeuroTimeout,Neuro,NeuroDevice,Header,DEFAULT_WINDOW,UNIX_PREFIX
+from pyneuro import formatAddress,peerAddress
+from pyneuro.eventloop import Poller,Wakeup,wait
+from pyneuro.output import OutputBuffer,DROP_OLDEST,DEFAULT_LIMIT,DEFAULT_MAX_BEHIND,DEFAULT_FLUSH_SIZE
+from pyneuro.framer import LineFramer,DEFAULT_READ_SIZE
+from pyneuro.samples import SampleBlock,TEXT,FLOAT32,INT16,fromPackets,fitsInt16
+from pyneuro.ring import NeuroDeviceProcess,HistoryRing,DEFAULT_RING_SIZE,DEFAULT_HISTORY
+from pyneuro.stats import ClientStats,Histogram,TRACE_STAGES,formatHistogram
+from pyneuro.clock import monotonic
+from pyneuro.recorder import EDFRecorder
+from pyneuro.decimator import Decimator,sourceRate
+from pyneuro.relay import NeuroRelay,RelaySource
+
+RE_WATCH = re.compile(r"^(un)?watch\s+([0-9]+)(?:\s+([0-9]*\.?[0-9]+))?(?:\s+channels\s+([0-9]+(?:\s*,\s*[0-9]+)*))?")
+RE_GETHEADER = re.compile(r"^getheader\s+([0-9]+)")
+RE_DATA = re.compile(r"^!(\s+[0-9]+)+")
+RE_SETHEADER = re.compile(r"^setheader\s(.*)")
+RE_BINARY = re.compile(r"^binary(?:\s+(float32|int16))?\s*$")
+RE_STREAM = re.compile(r"^stream(?:\s+([0-9]+))?\s*$")
+RE_TIMESTAMPS = re.compile(r"^timestamps(?:\s+(on|off))?\s*$")
+RE_FLUSH = re.compile(r"^flush\s+([0-9]*\.?[0-9]+)(?:\s+([0-9]+))?\s*$")
+RE_HISTORY = re.compile(r"^history\s+([0-9]+)\s+([0-9]*\.?[0-9]+)\s*$")
+
+NO_WATCHERS = frozenset()
+NO_CLIENT = (None, None, (), None, None)
 
 class NeuroDeviceProducer(Thread):
     def __init__(self, clId, caller):
@@ -21,12 +51,19 @@ class NeuroDeviceProducer(Thread):
         self.daemon = True
     
     def run(self):
-        while not self.caller.terminate.isSet():
-            if len(self.caller.getWatchers(self.clId)) > 0:
-                try:
-                    self.queue.put(self.caller.recvData(self.clId),1.0)
-                except Full:
-                    raise NeuroError("Queue busy. Dropping packet(s).")
+        try:
+            while not self.caller.terminate.isSet():
+                if self.caller.waitWatchers(self.clId, 1.0):
+                    try:
+                        for block in self.caller.recvData(self.clId):
+                            self.queue.put(block,1.0)
+                    except Full:
+                        raise NeuroError("Queue busy. Dropping packet(s).")
+                    self.caller.dataReady(self.clId)
+        except NeuroError as e:
+            print "*** Oops! {0} got: {1}".format(self.name, e)
+        finally:
+            self.caller.unregisterClient(self.clId)
             
 class NeuroSocketCommander(Thread):
     def __init__(self, clId, caller):
@@ -37,62 +74,244 @@ class NeuroSocketCommander(Thread):
         self.daemon = True
     
     def run(self):
-        while not self.caller.terminate.isSet():
-            try:
-                self.caller.recvCommands(self.clId)
-            except NeuroTimeout as e:
-                #print "*** Oops! Got: {0}".format(e)
-                pass
-            except NeuroError as e:
-                print "*** Oops! {0} got: {1}".format(threading.currentThread().name, e)
-                break
-            self.caller.getClientsForRole('Display')
-            if self.caller.isWatchingAny():
-                self.caller.watching.set()
-            else:
-                self.caller.watching.clear()
+        try:
+            while not self.caller.terminate.isSet():
+                try:
+                    self.caller.recvCommands(self.clId)
+                except NeuroTimeout as e:
+                    #print "*** Oops! Got: {0}".format(e)
+                    pass
+                except NeuroError as e:
+                    print "*** Oops! {0} got: {1}".format(threading.currentThread().name, e)
+                    break
+        finally:
+            self.caller.unregisterClient(self.clId)
 
 class NeuroSocketConsumer(Thread):
+    r"""Fan-out thread of the threaded server.
+    Sleeps until a source signals data through dataReady(), a reply is
+    queued, a backlogged watcher becomes writable or the coalescing interval
+    of one of them expires.
+    """
     def __init__(self, caller):
         threading.Thread.__init__(self)
         self.caller = caller
+        self.backlog = set()
         self.name = "SenderThread"
         self.daemon = True
     
     def run(self):
+        wakeup = self.caller.wakeup
         while not self.caller.terminate.isSet():
-            eegs = self.caller.getClientsForRole('EEG')
-            for eeg in eegs:
-                watchers = self.caller.getWatchers(eeg)
-                queue = self.caller.getQueues(eeg)
-                if queue.empty():
-                    continue
-                try:
-                    packet = queue.get(1.0)
-                except Empty:
-                    continue
-                if len(watchers) == 0:
+            fds = {}
+            timeout = 1.0
+            now = time()
+            for clId,sock in self.caller.getSockets(self.backlog):
+                output = self.caller.outputs.get(clId)
+                due = None
+                if sock is not None and output is not None:
+                    due = output.dueIn(now)
+                if due is None:
+                    self.backlog.discard(clId)
+                elif due > 0:
+                    timeout = min(timeout, due)
+                else:
+                    fds[sock.fileno()] = clId
+            readable, writable = wait([wakeup.fileno()], fds.keys(), timeout)
+            if len(readable) > 0:
+                wakeup.clear()
+            for fd in writable:
+                if self.caller.writeOutput(fds[fd]):
+                    self.backlog.discard(fds[fd])
+            self.caller.dispatch()
+            pending = self.caller.pending
+            while len(pending) > 0:
+                self.backlog.add(pending.popleft())
+            for clId in list(self.backlog):
+                if self.caller.checkStalled(clId):
+                    self.backlog.discard(clId)
+
+class NeuroServerLoop(object):
+    r"""Single threaded, non-blocking server core.
+    Multiplexes the listener, all client sockets and the fan-out in one loop.
+    Device producers keep their own threads, as device reads block, and wake
+    the loop up through dataReady().
+    """
+    def __init__(self, caller):
+        self.caller = caller
+        self.poller = Poller()
+        self.fds = {}
+        self.backlog = set()
+        self.deferred = set()
+        self.timeout = 1.0
+
+    def accept(self, listener):
+        while True:
+            try:
+                sock, addr = listener.accept()
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
                     continue
-                for watcher in watchers:
-                    sock = self.caller.getSocket(watcher)
-                    if sock is None:
-                        print "No socket"
-                        continue
-                    try:
-                        self.caller.send(packet, sock)
-                    except NeuroError as e:
-                        print "*** Oops! {0} got: {1}".format(threading.currentThread().name, e)
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    print "*** Oops! Accepting connection got: {0}".format(e)
+                return
+            sock.setblocking(0)
+            print "Connected client from {0}.".format(formatAddress(peerAddress(sock)))
+            clId = self.caller.registerClient('Unknown', '', [], None, sock)
+            self.fds[sock.fileno()] = clId
+            self.poller.register(sock.fileno())
+
+    def read(self, clId):
+        sock = self.caller.getSocket(clId)
+        try:
+            lines = self.caller.framers[clId].recv(sock)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            print "*** Oops! Client #{0} got: {1}".format(clId, e)
+            lines = None
+        except NeuroError as e:
+            print "*** Oops! Client #{0} got: {1}".format(clId, e)
+            lines = None
+        if lines is None:
+            self.drop(clId)
+            return
+        try:
+            self.caller.processCommands(clId, lines)
+        except Exception as e:
+            print "*** Oops! Client #{0} got: {1}".format(clId, e)
+            self.drop(clId)
+
+    def write(self, clId):
+        sock = self.caller.getSocket(clId)
+        empty = self.caller.writeOutput(clId)
+        if clId not in self.caller.outputs:
+            return
+        self.poller.modify(sock.fileno(), not empty)
+        if empty:
+            self.backlog.discard(clId)
+        else:
+            self.backlog.add(clId)
+
+    def drop(self, clId):
+        sock = self.caller.getSocket(clId)
+        if sock is None:
+            return
+        fd = sock.fileno()
+        self.poller.unregister(fd)
+        del self.fds[fd]
+        self.backlog.discard(clId)
+        self.deferred.discard(clId)
+        self.caller.unregisterClient(clId)
+
+    def flush(self):
+        r"""Writes the output that is due and sets the poll timeout to
+        the time until the next coalesced output is.
+        """
+        pending = self.caller.pending
+        while len(pending) > 0:
+            clId = pending.popleft()
+            if clId not in self.backlog:
+                self.deferred.add(clId)
+        self.timeout = 1.0
+        now = time()
+        for clId in list(self.deferred):
+            output = self.caller.outputs.get(clId)
+            due = None
+            if output is not None and clId not in self.backlog:
+                due = output.dueIn(now)
+            if due is None:
+                self.deferred.discard(clId)
+            elif due > 0:
+                self.timeout = min(self.timeout, due)
+            else:
+                self.deferred.discard(clId)
+                self.write(clId)
+        for clId in list(self.backlog):
+            self.caller.checkStalled(clId)
+
+    def run(self):
+        listeners = dict([ (l.fileno(), l) for l in self.caller.getListeners() ])
+        wakeup = self.caller.wakeup
+        for fd, listener in listeners.items():
+            listener.setblocking(0)
+            self.poller.register(fd)
+        self.poller.register(wakeup.fileno())
+        while not self.caller.terminate.isSet():
+            for fd, readable, writable in self.poller.poll(self.timeout):
+                if fd in listeners:
+                    self.accept(listeners[fd])
+                elif fd == wakeup.fileno():
+                    wakeup.clear()
+                elif fd in self.fds:
+                    clId = self.fds[fd]
+                    if readable:
+                        self.read(clId)
+                    if writable and clId in self.caller.outputs:
+                        self.write(clId)
+            self.caller.dispatch()
+            self.flush()
+
+    def close(self):
+        for clId in self.fds.values():
+            self.drop(clId)
+        self.poller.close()
 
 class NeuroServer(Neuro):
-    def __init__(self, address, device, queueSize = 0):
+    def __init__(self, address, device, queueSize = 0, eventLoop = False,
+            outputSize = DEFAULT_LIMIT, outputPolicy = DROP_OLDEST, maxBehind = DEFAULT_MAX_BEHIND,
+            readSize = DEFAULT_READ_SIZE, processes = False, ringSize = DEFAULT_RING_SIZE,
+            trace = False, recordDir = None, flushInterval = 0.0, flushSize = DEFAULT_FLUSH_SIZE,
+            upstream = None, upstreamFormat = FLOAT32, unixPath = None, history = DEFAULT_HISTORY):
         Neuro.__init__(self, address, device)
+        self.started = time()
         self.queueSize = queueSize
+        self.eventLoop = eventLoop
+        self.processes = processes
+        self.ringSize = ringSize
+        self.readSize = readSize
+        # the event loop reads one connection at a time into a shared buffer
+        self.readBuffer = bytearray(readSize) if eventLoop else None
+        self.framers = {}
+        self.formats = {}
+        self.streams = {}
+        self.stats = {}
+        self.stamped = set()
+        self.recordDir = recordDir
+        self.recorders = {}
+        self.subscriptions = {}
+        self.decimators = {}
+        self.trace = trace
+        self.traces = dict([ (stage, Histogram()) for stage in TRACE_STAGES ])
+        self.outputSize = outputSize
+        self.outputPolicy = outputPolicy
+        self.maxBehind = maxBehind
+        self.flushInterval = flushInterval
+        self.flushSize = flushSize
+        self.upstream = upstream
+        self.upstreamFormat = upstreamFormat
+        self.relay = None
+        self.unixPath = unixPath
+        self.unixListener = None
+        self.history = history
+        self.histories = {}
+        self.historyLock = Lock()
+        self.outputs = {}
+        self.pending = deque()
+        self.readyIds = deque()
+        self.wakeup = Wakeup()
+        self.loop = None
+        self.consumer = None
         self.listener = None
         self.socket = None
         self.queues = {}
         self.clients = {}
+        self.roles = {}
+        self.watchers = {}
+        self.nextId = 0
         self.queuesLock = RLock()
         self.clientsLock = RLock()
+        self.watchersChanged = Condition(self.clientsLock)
         self.watching = Event()
         self.terminate = Event()
         self.terminate.clear()
@@ -104,7 +323,16 @@ class NeuroServer(Neuro):
             self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.listener.bind(self.address)
-            self.listener.listen(1)
+            self.listener.listen(socket.SOMAXCONN)
+        if self.unixPath is not None and self.unixListener is None:
+            if os.path.exists(self.unixPath) and stat.S_ISSOCK(os.stat(self.unixPath).st_mode):
+                os.unlink(self.unixPath) # left over by a server that did not clean up
+            self.unixListener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.unixListener.bind(self.unixPath)
+            self.unixListener.listen(socket.SOMAXCONN)
+
+    def getListeners(self):
+        return [ l for l in (self.listener, self.unixListener) if l is not None ]
     
     def getQueues(self, client = None):
         self.queuesLock.acquire()
@@ -112,7 +340,7 @@ class NeuroServer(Neuro):
             if client is None:
                 return self.queues.copy()
             else:
-                return self.queues[client]
+                return self.queues.get(client)
                 
         finally:
             self.queuesLock.release()
@@ -127,17 +355,28 @@ class NeuroServer(Neuro):
     def registerClient(self, role, header, watching, ThreadClass, sock):
         self.clientsLock.acquire()
         try:
-            if len(self.clients) == 0:
-                clId = 0
-            else:
-                clId = max(self.clients)+1
+            clId = self.nextId
+            self.nextId += 1
             if role == 'EEG':
                 self.setQueues(clId, Queue(self.queueSize))
-            thread = ThreadClass(clId, self)
-            self.clients[clId] = [role, header, watching, thread, sock]
-            thread.start()
+                self.addHistory(clId)
+            if ThreadClass is None:
+                thread = None
+            else:
+                thread = ThreadClass(clId, self)
+            self.clients[clId] = [role, header, [], thread, sock]
+            self.roles.setdefault(role, set()).add(clId)
+            self.stats[clId] = ClientStats()
+            self.setWatching(clId, watching)
             if isinstance(sock,socket.socket):
-                s = "Registered {0} client #{1} from {2}:{3}.".format(role.lower(), clId, *sock.getpeername())
+                self.outputs[clId] = OutputBuffer(self.outputSize, self.outputPolicy, self.maxBehind,
+                                                  self.flushInterval, self.flushSize)
+                self.framers[clId] = LineFramer(self.readSize, buffer = self.readBuffer)
+                self.setNoDelay(clId)
+            if thread is not None:
+                thread.start()
+            if isinstance(sock,socket.socket):
+                s = "Registered {0} client #{1} from {2}.".format(role.lower(), clId, formatAddress(peerAddress(sock)))
             else:
                 s = "Registered {0} client #{1}.".format(role.lower(), clId)
             if header != '':
@@ -147,65 +386,343 @@ class NeuroServer(Neuro):
         finally:
             self.clientsLock.release()
     
+    def unregisterClient(self, clId):
+        r"""Removes clId from the registry and frees its resources.
+        Called once the connection or device of the client has gone away.
+        """
+        self.clientsLock.acquire()
+        try:
+            if clId not in self.clients:
+                return
+            watched = set(self.getWatching(clId))
+            self.setWatching(clId, [])
+            for cl in self.getWatchers(clId):
+                self.removeWatch(cl, clId)
+            self.roles[self.getRole(clId)].discard(clId)
+            sock = self.clients.pop(clId)[4]
+            self.outputs.pop(clId, None)
+            self.framers.pop(clId, None)
+            self.formats.pop(clId, None)
+            self.streams.pop(clId, None)
+            self.stats.pop(clId, None)
+            self.stamped.discard(clId)
+            self.lastSeq.pop(clId, None)
+            self.histories.pop(clId, None)
+            for key in self.subscriptions.keys():
+                if clId in key:
+                    watched.add(key[0])
+                    del self.subscriptions[key]
+            # the decimators of clId and those clId made on the sources it watched
+            watched.add(clId)
+            for target in watched:
+                self.pruneDecimators(target)
+        finally:
+            self.clientsLock.release()
+        self.queuesLock.acquire()
+        try:
+            self.queues.pop(clId, None)
+        finally:
+            self.queuesLock.release()
+        if isinstance(sock,socket.socket):
+            sock.close()
+        elif isinstance(sock,NeuroDeviceProcess):
+            sock.close()
+        self.stopRecording(clId)
+        print "Client #{0} disconnected. Cleaning up.".format(clId)
+    
     def getRole(self, clId):
         self.clientsLock.acquire()
         try:
-            return self.clients[clId][0]
+            return self.clients.get(clId, NO_CLIENT)[0]
         finally:
             self.clientsLock.release()
     
     def getHeader(self, clId):
         self.clientsLock.acquire()
         try:
-            return self.clients[clId][1]
+            return self.clients.get(clId, NO_CLIENT)[1]
         finally:
             self.clientsLock.release()
     
     def getWatching(self, clId):
         self.clientsLock.acquire()
         try:
-            return self.clients[clId][2]
+            return self.clients.get(clId, NO_CLIENT)[2]
         finally:
             self.clientsLock.release()
     
     def isWatching(self, clId):
         self.clientsLock.acquire()
         try:
-            return len(self.clients[clId][2]) > 0
+            return len(self.clients.get(clId, NO_CLIENT)[2]) > 0
         finally:
             self.clientsLock.release()
             
     def getThread(self, clId):
         self.clientsLock.acquire()
         try:
-            return self.clients[clId][3]
+            return self.clients.get(clId, NO_CLIENT)[3]
         finally:
             self.clientsLock.release()
-    
+
     def getWatchers(self, clId):
+        r"""Returns the frozenset of clients watching clId.
+        Reads the reverse index without locking, the sets are replaced
+        and never mutated by addWatch, removeWatch and unregisterClient.
+        """
+        return self.watchers.get(clId, NO_WATCHERS)
+    
+    def indexWatcher(self, target, clId, add):
+        watchers = self.watchers.get(target, NO_WATCHERS)
+        if add:
+            watchers = watchers | frozenset((clId,))
+        else:
+            watchers = watchers - frozenset((clId,))
+        if len(watchers) > 0:
+            self.watchers[target] = watchers
+        else:
+            self.watchers.pop(target, None)
+        if len(self.watchers) > 0:
+            self.watching.set()
+        else:
+            self.watching.clear()
+        self.watchersChanged.notifyAll()
+    
+    def hasConsumers(self, clId):
+        r"""Tells whether samples of clId are watched, recorded or kept in
+        its history.
+        """
+        return clId in self.watchers or clId in self.recorders or clId in self.histories
+
+    def waitWatchers(self, clId, timeout):
+        r"""Blocks until clId has a watcher or a recorder or timeout elapses."""
+        if self.hasConsumers(clId):
+            return True
+        self.clientsLock.acquire()
+        try:
+            if not self.hasConsumers(clId):
+                self.watchersChanged.wait(timeout)
+            return self.hasConsumers(clId)
+        finally:
+            self.clientsLock.release()
+
+    def addHistory(self, clId):
+        if self.history > 0 and clId not in self.histories:
+            self.histories[clId] = HistoryRing(self.history)
+
+    def sendHistory(self, clId, target, seconds):
+        r"""Sends the samples of target of the last seconds to clId and makes
+        clId watch target, with no samples lost or repeated in between. The
+        reply "200 OK <first> <count>" precedes the samples, which span count
+        sequence numbers from first; the live samples follow. A client
+        already watching target keeps its subscription and may receive
+        samples twice.
+        """
+        subscription = self.subscriptions.get((target, clId))
+        if subscription is not None and subscription[0] > 1:
+            raise NeuroError("decimated samples are not kept.")
+        self.checkFormat(target, self.formats.get(clId))
+        output = self.outputs.get(clId)
+        if output is None:
+            raise NeuroError("Client #{0} has been disconnected.".format(clId))
+        fmt = self.formats.get(clId, TEXT)
+        stamped = clId in self.stamped
+        self.historyLock.acquire()
+        try:
+            history = self.histories.get(target)
+            if history is None:
+                raise NeuroError("no history is kept.")
+            blocks = history.get(target, seconds, monotonic())
+            end = history.next or 0
+            first = blocks[0].seq if len(blocks) > 0 else end
+            data = [ "200 OK {0} {1}\r\n".format(first, end - first) ]
+            count = 0
+            for block in blocks:
+                if subscription is not None:
+                    block = self.subscribe(block, subscription)
+                    if block is None:
+                        continue
+                data.append(block.encode(fmt, stamped))
+                count += block.count
+            output.push(''.join(data), False)
+            # 'historyLock' also serializes this with broadcast()
+            stats = self.stats.get(clId)
+            if stats is not None:
+                stats.samplesOut += count
+            if target not in self.getWatching(clId):
+                self.addWatch(clId, target)
+        finally:
+            self.historyLock.release()
+        self.pending.append(clId)
+        self.wakeup.set()
+
+    def startRecording(self, clId, path = None):
+        r"""Starts recording the samples of EEG client clId into the EDF file
+        path, by default a new file in 'recordDir'. Returns the path.
+        """
+        if self.getRole(clId) != 'EEG':
+            raise NeuroError("Client #{0} is not EEG device.".format(clId))
+        if clId in self.recorders:
+            return self.recorders[clId].path
+        if path is None:
+            if self.recordDir is None:
+                raise NeuroError("No recording directory set.")
+            name = 'eeg-{0}-{1:%Y%m%d-%H%M%S}.edf'.format(clId, datetime.datetime.now())
+            path = os.path.join(self.recordDir, name)
+        try:
+            recorder = EDFRecorder(path, self.getHeader(clId))
+        except (ValueError, IOError) as e:
+            raise NeuroError("Cannot record client #{0}: {1}".format(clId, e))
+        recorder.name = "RecorderThread-{0}".format(clId)
+        recorder.start()
+        self.clientsLock.acquire()
+        try:
+            self.recorders[clId] = recorder
+            self.watchersChanged.notifyAll()
+        finally:
+            self.clientsLock.release()
+        print "Recording client #{0} to {1}.".format(clId, path)
+        return path
+
+    def stopRecording(self, clId):
+        recorder = self.recorders.pop(clId, None)
+        if recorder is None:
+            return
+        recorder.close()
+        print "Recorded {0} data records of client #{1} to {2}.".format(recorder.records, clId, recorder.path)
+        if recorder.gaps > 0 or recorder.drops > 0:
+            print "*** Oops! {0} samples of client #{1} were dropped, {2} gaps padded with {3} samples.".format(
+                recorder.drops, clId, recorder.gaps, recorder.padded)
+
+    def record(self, clId, blocks):
+        recorder = self.recorders.get(clId)
+        if recorder is not None:
+            for block in blocks:
+                recorder.put(block)
+    
+    def addWatch(self, clId, target, factor = 1, channels = None):
+        r"""Makes clId watch target, receiving every factor-th sample of
+        the low-pass filtered source if factor is above 1, and only the
+        channels of the indices in channels unless it is None.
+        """
         self.clientsLock.acquire()
         try:
-            retArr = []
-            for id in self.clients:
-                if clId in self.getWatching(id):
-                    retArr.append(id)
-            return retArr
+            if factor > 1 or channels is not None:
+                self.subscriptions[(target, clId)] = (factor, channels)
+            else:
+                self.subscriptions.pop((target, clId), None)
+            self.pruneDecimators(target)
+            if target not in self.clients[clId][2]:
+                self.clients[clId][2].append(target)
+                self.indexWatcher(target, clId, True)
         finally:
             self.clientsLock.release()
     
+    def removeWatch(self, clId, target):
+        self.clientsLock.acquire()
+        try:
+            if target in self.clients[clId][2]:
+                self.clients[clId][2].remove(target)
+                self.indexWatcher(target, clId, False)
+            self.subscriptions.pop((target, clId), None)
+            self.pruneDecimators(target)
+        finally:
+            self.clientsLock.release()
+
+    def getFactor(self, target, rate):
+        r"""Returns the largest decimation factor of target which keeps at
+        least rate samples per second, 1 for a rate of 0.
+        """
+        source = sourceRate(self.getHeader(target))
+        if source is None:
+            raise NeuroError("sampling rate of client #{0} is not known.".format(target))
+        if rate <= 0:
+            return 1
+        return max(1, int(source // rate))
+
+    def getChannels(self, target, spec):
+        r"""Parses spec, comma separated channel indices of target, into a
+        tuple. Returns None if spec selects all channels in their order.
+        """
+        try:
+            count = Header(self.getHeader(target)).channelCount
+        except (ValueError, TypeError):
+            raise NeuroError("header of client #{0} is not valid.".format(target))
+        channels = tuple([ int(c) for c in spec.split(',') ])
+        if max(channels) >= count:
+            raise NeuroError("client #{0} has only {1} channels.".format(target, count))
+        if len(set(channels)) != len(channels):
+            raise NeuroError("channels are repeated.")
+        if channels == tuple(range(count)):
+            return None
+        return channels
+
+    def checkFormat(self, target, fmt):
+        r"""Raises NeuroError if samples of target cannot be sent in wire
+        format fmt, see fitsInt16().
+        """
+        if fmt == INT16 and not fitsInt16(self.getHeader(target)):
+            raise NeuroError("samples of client #{0} do not fit int16 frames.".format(target))
+
+    def getSubscribedHeader(self, clId, target):
+        r"""Returns the header of target as seen by its watcher clId."""
+        header = self.getHeader(target)
+        channels = self.subscriptions.get((target, clId), (1, None))[1]
+        if channels is not None:
+            header = Header(header).select(channels).text
+        return header
+
+    def pruneDecimators(self, target):
+        r"""Drops the decimators of target no watcher uses any more."""
+        used = set([ s for (t, w), s in self.subscriptions.items() if t == target ])
+        for key in self.decimators.keys():
+            if key[0] == target and key[1:] not in used:
+                self.decimators.pop(key, None)
+
+    def subscribe(self, block, subscription):
+        r"""Returns block reduced to subscription, a (factor, channels)
+        pair, or None if nothing is left of it. Channels are selected before
+        decimating, so only the selected ones are filtered. One Decimator is
+        kept per source and subscription and shared by all its watchers.
+        Called from the fan-out thread only.
+        """
+        factor, channels = subscription
+        if channels is not None:
+            block = block.select(channels)
+            if block is None:
+                return None
+        if factor > 1:
+            key = (block.clId, factor, channels)
+            decimator = self.decimators.get(key)
+            if decimator is None:
+                decimator = Decimator(factor)
+                self.decimators[key] = decimator
+            block = decimator.process(block)
+        return block
+    
     def getSocket(self, clId):
         self.clientsLock.acquire()
         try:
-            return self.clients[clId][4]
+            return self.clients.get(clId, NO_CLIENT)[4]
+        finally:
+            self.clientsLock.release()
+    
+    def getSockets(self, clIds):
+        self.clientsLock.acquire()
+        try:
+            return [ (clId, self.clients.get(clId, NO_CLIENT)[4]) for clId in clIds ]
         finally:
             self.clientsLock.release()
     
     def setRole(self, clId, value):
         self.clientsLock.acquire()
         try:
+            self.roles[self.clients[clId][0]].discard(clId)
+            self.roles.setdefault(value, set()).add(clId)
             self.clients[clId][0] = value
             if value == 'EEG':
                 self.setQueues(clId, Queue(self.queueSize))
+                self.addHistory(clId)
         finally:
             self.clientsLock.release()
     
@@ -219,99 +736,356 @@ class NeuroServer(Neuro):
     def setWatching(self, clId, value):
         self.clientsLock.acquire()
         try:
+            for target in self.clients[clId][2]:
+                self.indexWatcher(target, clId, False)
             self.clients[clId][2] = value
+            for target in value:
+                self.indexWatcher(target, clId, True)
         finally:
             self.clientsLock.release()
     
     def isWatchingAny(self):
-        self.clientsLock.acquire()
-        try:
-            for val in self.clients.values():
-                if len(val[2]) > 0:
-                    return True
-            return False
-        finally:
-            self.clientsLock.release()
+        return len(self.watchers) > 0
     
     def getClientsForRole(self, role):
         self.clientsLock.acquire()
         try:
-            dead = []
-            for id in self.clients:
-                thread = self.getThread(id)
-                if thread is None or not thread.isAlive():
-                    if thread is not None:
-                        print "Client #{0} found dead. Cleaning up..".format(id)
-                    dead.append(id)
-            retArr = []
-            for id,val in self.clients.items():
-                if id in dead:
-                    val[:] = [None, None, [], None, None]
-                    for cl in self.getWatchers(id):
-                        self.getWatching(cl).remove(id)
-                else:
-                    if self.getRole(id) == role:
-                        retArr.append(id)
-            return retArr
+            return sorted(self.roles.get(role, ()))
         finally:
             self.clientsLock.release()
     
     def getStatus(self):
         self.clientsLock.acquire()
         try:
-            dead = []
-            for id in self.clients:
-                thread = self.getThread(id)
-                if thread is None or not thread.isAlive():
-                    if thread is not None:
-                        print "Client #{0} found dead. Cleaning up.".format(id)
-                    dead.append(id)
-            nClients = 0
-            clientList = []            
-            for id,val in self.clients.items():
-                if id in dead:
-                    val[:] = [None, None, [], None, None]
-                    for cl in self.getWatchers(id):
-                        self.getWatching(cl).remove(id)
-                else:
-                    nClients += 1
-                    clientList.append('{0}:{1}'.format(id, self.getRole(id) ))
-            clientList.insert(0, '{0} clients connected'.format(nClients))
+            clientList = [ '{0}:{1}'.format(id, self.getRole(id)) for id in sorted(self.clients) ]
+            clientList.insert(0, '{0} clients connected'.format(len(clientList)))
             return '\r\n'.join(clientList)
         finally:
             self.clientsLock.release()
-    
-    def recvCommands(self, clId):
-        #Note: this is crap, it should be rewritten soon
-        reW = re.compile(r"^(un)?watch\s+([0-9]+)")
-        reH = re.compile(r"^getheader\s+([0-9]+)")
-        reD = re.compile(r"^!(\s+[0-9]+)+")
-        reS = re.compile(r"^setheader\s(.*)")
+
+    def getStats(self, clId = None):
+        r"""Returns statistics of clId as a dictionary, or of all clients as
+        a dictionary keyed by client id. Rates are per second. 'queue' is
+        the number of blocks waiting in the ingest queue of an EEG client,
+        'buffered' (bytes) and 'behind' (seconds) describe the output buffer
+        and 'latency' holds (upper bound in seconds, count) pairs of the
+        time packets spent between enqueue and send.
+        """
+        if clId is None:
+            self.clientsLock.acquire()
+            try:
+                ids = sorted(self.clients)
+            finally:
+                self.clientsLock.release()
+            return dict([ (id, self.getStats(id)) for id in ids ])
+        stats = self.stats.get(clId)
+        if stats is None:
+            return None
+        now = time()
+        framer = self.framers.get(clId)
+        output = self.outputs.get(clId)
+        queue = self.getQueues(clId)
+        sock = self.getSocket(clId)
+        bytesIn = bytesOut = drops = buffered = 0
+        behind = 0.0
+        latency = []
+        if framer is not None:
+            bytesIn = framer.received
+        if output is not None:
+            bytesOut, drops, buffered = output.sent, output.drops, output.size
+            behind = output.behind(now)
+            latency = output.latency.items()
+        if isinstance(sock,NeuroDeviceProcess):
+            drops += sock.ring.overruns
+        elif isinstance(sock,RelaySource):
+            drops += sock.drops
+        rates = stats.rates((stats.samplesIn, bytesIn, stats.samplesOut, bytesOut), now)
+        return { 'role': self.getRole(clId),
+                 'samplesIn': rates[0], 'bytesIn': rates[1],
+                 'samplesOut': rates[2], 'bytesOut': rates[3],
+                 'queue': 0 if queue is None else queue.qsize(),
+                 'buffered': buffered, 'behind': behind,
+                 'drops': drops, 'gaps': stats.gaps, 'latency': latency }
+
+    def getStatsText(self):
+        lines = []
+        for clId, s in sorted(self.getStats().items()):
+            if s is None:
+                continue
+            latency = formatHistogram(s['latency'])
+            lines.append(('{0}:{1} samplesIn={2:.1f}/s bytesIn={3:.1f}/s samplesOut={4:.1f}/s bytesOut={5:.1f}/s '
+                          'queue={6} buffered={7} behind={8:.3f}s drops={9} gaps={10} latency={11}').format(
+                          clId, s['role'], s['samplesIn'], s['bytesIn'], s['samplesOut'], s['bytesOut'],
+                          s['queue'], s['buffered'], s['behind'], s['drops'], s['gaps'], latency))
+        lines.insert(0, '{0} clients connected'.format(len(lines)))
+        return '\r\n'.join(lines)
+
+    def getTrace(self):
+        r"""Returns the histograms of time spent in each of TRACE_STAGES as
+        lists of (upper bound in seconds, count) pairs. Apart from 'send',
+        which is part of the statistics, stages are recorded only while
+        'trace' is set.
+        """
+        send = Histogram()
+        for output in self.outputs.values():
+            send.merge(output.latency)
+        trace = dict([ (stage, h.items()) for stage,h in self.traces.items() ])
+        trace['send'] = send.items()
+        return trace
+
+    def getTraceText(self):
+        trace = self.getTrace()
+        return '\r\n'.join([ '{0} {1}'.format(stage, formatHistogram(trace[stage])) for stage in TRACE_STAGES ])
+
+    def countSamples(self, clId, seq, count):
+        r"""Accounts count samples of clId starting at seq.
+        Returns False if they do not continue the previous sequence.
+        """
+        stats = self.stats.get(clId)
+        if stats is not None:
+            stats.samplesIn += count
+        last = self.lastSeq.get(clId)
+        self.lastSeq[clId] = seq + count - 1
+        if last is not None and last + 1 != seq:
+            if stats is not None:
+                stats.gaps += 1
+            return False
+        return True
+
+    def dataReady(self, clId):
+        self.readyIds.append(clId)
+        self.wakeup.set()
+
+    def dispatch(self):
+        r"""Drains the queues of all sources signalled by dataReady().
+        Blocks are kept in the history of their source and broadcast under
+        'historyLock', so sendHistory() sees every block either in the
+        history or as a live one.
+        """
+        while len(self.readyIds) > 0:
+            eeg = self.readyIds.popleft()
+            queue = self.getQueues(eeg)
+            if queue is None:
+                continue
+            history = self.histories.get(eeg)
+            while True:
+                try:
+                    packet = queue.get_nowait()
+                except Empty:
+                    break
+                if self.trace and packet.time is not None:
+                    self.traces['queue'].add(monotonic() - packet.time)
+                self.historyLock.acquire()
+                try:
+                    if history is not None:
+                        history.put(packet, monotonic())
+                    watchers = self.getWatchers(eeg)
+                    if len(watchers) > 0:
+                        self.broadcast(packet, watchers)
+                finally:
+                    self.historyLock.release()
+
+    def broadcast(self, block, watchers):
+        r"""Sends one SampleBlock to all watchers, called under 'historyLock'.
+        The block is serialized once per wire format and the same string is
+        shared by every watcher using that format, so the cost per additional
+        watcher is one write. Likewise the block is reduced once per
+        subscription for the watchers of a lower rate or fewer channels.
+        """
+        if self.trace:
+            start = monotonic()
+        outputs = self.outputs
+        formats = self.formats
+        stamped = self.stamped
+        subscriptions = self.subscriptions
+        reduced = {}
+        for watcher in watchers:
+            output = outputs.get(watcher)
+            if output is not None:
+                data = block
+                subscription = subscriptions.get((block.clId, watcher))
+                if subscription is not None:
+                    if subscription not in reduced:
+                        reduced[subscription] = self.subscribe(block, subscription)
+                    data = reduced[subscription]
+                    if data is None:
+                        continue
+                if output.push(data.encode(formats.get(watcher, TEXT), watcher in stamped)):
+                    stats = self.stats.get(watcher)
+                    if stats is not None:
+                        stats.samplesOut += data.count
+                self.pending.append(watcher)
+        if self.trace:
+            self.traces['serialize'].add(monotonic() - start)
+
+    def setFlush(self, clId, interval, size = None):
+        r"""Makes the server coalesce sample output to clId into writes at
+        most interval seconds apart or of size bytes, 0 writes every block as
+        soon as possible.
+        """
+        output = self.outputs.get(clId)
+        if output is None:
+            return
+        output.interval = interval
+        if size is not None:
+            output.threshold = size
+        self.setNoDelay(clId)
+
+    def setNoDelay(self, clId):
+        r"""Disables Nagle's algorithm for clients whose output is coalesced
+        by the server, it would only hold the batched writes back further.
+        Uncoalesced output keeps it so the kernel merges small writes.
+        """
         sock = self.getSocket(clId)
-        lines = self.recv(sock).splitlines()
-        if len(lines) == 0:
+        output = self.outputs.get(clId)
+        if not isinstance(sock,socket.socket) or output is None:
+            return
+        if hasattr(socket, 'AF_UNIX') and sock.family == socket.AF_UNIX:
+            return
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if output.interval > 0 else 0)
+        except socket.error:
+            pass
+
+    def reply(self, clId, data):
+        output = self.outputs.get(clId)
+        if output is None:
+            raise NeuroError("Client #{0} has been disconnected.".format(clId))
+        output.push(data+'\r\n', False)
+        self.pending.append(clId)
+        self.wakeup.set()
+
+    def writeOutput(self, clId):
+        r"""Writes queued output of clId without blocking.
+        Returns True if nothing is left to be written.
+        """
+        output = self.outputs.get(clId)
+        if output is None:
+            return True
+        try:
+            return output.write(self.getSocket(clId))
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return False
+            print "*** Oops! Client #{0} got: {1}".format(clId, e)
+            self.disconnect(clId)
+            return True
+
+    def checkStalled(self, clId):
+        output = self.outputs.get(clId)
+        if output is None or not output.isStalled():
+            return False
+        print "Client #{0} is {1:.1f} s behind. Disconnecting.".format(clId, output.behind())
+        self.disconnect(clId)
+        return True
+
+    def getDrops(self, clId):
+        output = self.outputs.get(clId)
+        if output is None:
+            return 0
+        return output.drops
+
+    def disconnect(self, clId):
+        if self.loop is not None:
+            self.loop.drop(clId)
+            return
+        self.outputs.pop(clId, None)
+        sock = self.getSocket(clId)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def recvLines(self, clId):
+        r"""Reads once from the socket of clId and returns complete lines."""
+        framer = self.framers.get(clId)
+        if framer is None:
+            raise NeuroError("Socket is not open.")
+        try:
+            lines = framer.recv(self.getSocket(clId))
+        except socket.timeout:
+            raise NeuroTimeout("Timeout reading socket.")
+        except socket.error as e:
+            raise NeuroError("Error reading socket: {0}".format(e))
+        if lines is None:
             raise NeuroError("No commands received. Is socket opened?")
-        messages = []
+        return lines
+
+    def recvCommands(self, clId):
+        lines = self.recvLines(clId)
+        if len(lines) > 0:
+            self.processCommands(clId, lines)
+
+    def processCommands(self, clId, lines):
+        #Note: this is crap, it should be rewritten soon
+        reW = RE_WATCH
+        reH = RE_GETHEADER
+        reD = RE_DATA
+        reS = RE_SETHEADER
+        reB = RE_BINARY
+        reT = RE_STREAM
+        reTS = RE_TIMESTAMPS
+        reF = RE_FLUSH
+        reHi = RE_HISTORY
+        blocks = []
+        stream = self.streams.get(clId)
         for msg in lines:
+            if isinstance(msg, SampleBlock):
+                self.countSamples(clId, msg.seq, msg.count)
+                if self.hasConsumers(clId):
+                    msg.clId = clId
+                    blocks.append(msg)
+                if stream is None:
+                    self.reply(clId, "200 OK")
+                else:
+                    stream[1] += msg.count
+                continue
             mW = reW.match(msg)
             mH = reH.match(msg)
             mD = reD.match(msg)
             mS = reS.match(msg)
+            mB = reB.match(msg)
+            mT = reT.match(msg)
+            mTS = reTS.match(msg)
+            mF = reF.match(msg)
+            mHi = reHi.match(msg)
             if msg.strip() == 'display':
                 print "Client #{0} issued 'display' command.".format(clId)
                 self.setRole(clId, "Display")
-                self.send("200 OK", sock)
+                self.reply(clId, "200 OK")
             elif msg.strip() == 'eeg':
                 print "Client #{0} issued 'eeg' command.".format(clId)
                 self.setRole(clId, "EEG")
-                self.send("200 OK", sock)
+                self.reply(clId, "200 OK")
             elif msg.strip() == 'status':
                 print "Client #{0} issued 'status' command.".format(clId)
-                #self.send("200 OK", sock)
-                self.send("200 OK\r\n"+self.getStatus(), sock) # brainbay cannot recognize if it is separated
+                #self.reply(clId, "200 OK")
+                self.reply(clId, "200 OK\r\n"+self.getStatus()) # brainbay cannot recognize if it is separated
+            elif msg.strip() == 'stats':
+                print "Client #{0} issued 'stats' command.".format(clId)
+                self.reply(clId, "200 OK\r\n"+self.getStatsText())
+            elif msg.strip() == 'trace':
+                print "Client #{0} issued 'trace' command.".format(clId)
+                self.reply(clId, "200 OK\r\n"+self.getTraceText())
+            elif msg.strip() == 'time':
+                # the start time tells reconnecting clients whether the server was restarted
+                self.reply(clId, "200 OK {0:.6f} {1:.6f}".format(monotonic(), self.started))
+            elif mTS is not None:
+                print "Client #{0} issued 'timestamps' command.".format(clId)
+                self.reply(clId, "200 OK")
+                if mTS.group(1) == 'off':
+                    self.stamped.discard(clId)
+                else:
+                    self.stamped.add(clId)
+            elif mF is not None:
+                print "Client #{0} issued '{1}' command.".format(clId, msg.strip())
+                self.reply(clId, "200 OK")
+                size = None if mF.group(2) is None else int(mF.group(2))
+                self.setFlush(clId, float(mF.group(1)) / 1000, size)
             elif msg.strip() == 'role':
                 print "Client #{0} issued 'role' command.".format(clId)
-                self.send(self.getRole(clId), sock)
+                self.reply(clId, self.getRole(clId))
             elif mW is not None:
                 target = int(mW.group(2))
                 if self.getRole(clId) != "Display" or  self.getRole(target) != 'EEG':
@@ -319,95 +1093,282 @@ class NeuroServer(Neuro):
                         print "Client #{0} issued 'unwatch' command but not in display role or target is not EEG.".format(clId)
                     else:
                         print "Client #{0} issued 'watch' command but not in display role or target is not EEG.".format(clId)
-                    self.send('400 BAD REQUEST', sock)
+                    self.reply(clId, '400 BAD REQUEST')
+                elif mW.group(1) != 'un' and (mW.group(3) is not None or mW.group(4) is not None):
+                    factor, channels = 1, None
+                    try:
+                        if mW.group(3) is not None:
+                            factor = self.getFactor(target, float(mW.group(3)))
+                        if mW.group(4) is not None:
+                            channels = self.getChannels(target, mW.group(4))
+                        self.checkFormat(target, self.formats.get(clId))
+                    except NeuroError as e:
+                        print "Client #{0} issued '{1}' command but {2}".format(clId, msg.strip(), e)
+                        self.reply(clId, '400 BAD REQUEST')
+                    else:
+                        print "Client #{0} issued '{1}' command, decimating by {2}.".format(clId, msg.strip(), factor)
+                        if mW.group(3) is None:
+                            self.reply(clId, "200 OK")
+                        else:
+                            self.reply(clId, "200 OK {0:g}".format(sourceRate(self.getHeader(target)) / factor))
+                        self.addWatch(clId, target, factor, channels)
+                elif mW.group(1) == 'un':
+                    self.reply(clId, "200 OK")
+                    print "Client #{0} issued 'unwatch {1}' command.".format(clId, target)
+                    #print "target={0} watching={1}".format(target, self.getWatching(clId))
+                    self.removeWatch(clId, target)
                 else:
-                    self.send("200 OK", sock)
-                    if mW.group(1) == 'un':
-                        print "Client #{0} issued 'unwatch {1}' command.".format(clId, target)
-                        #print "target={0} watching={1}".format(target, self.getWatching(clId))
-                        self.getWatching(clId).remove(target)
+                    try:
+                        self.checkFormat(target, self.formats.get(clId))
+                    except NeuroError as e:
+                        print "Client #{0} issued 'watch {1}' command but {2}".format(clId, target, e)
+                        self.reply(clId, '400 BAD REQUEST')
                     else:
+                        self.reply(clId, "200 OK")
                         print "Client #{0} issued 'watch {1}' command.".format(clId, target)
-                        self.getWatching(clId).append(target)
+                        self.addWatch(clId, target)
+            elif mHi is not None:
+                target = int(mHi.group(1))
+                if self.getRole(clId) != "Display" or  self.getRole(target) != 'EEG':
+                    print "Client #{0} issued 'history' command but not in display role or target is not EEG.".format(clId)
+                    self.reply(clId, '400 BAD REQUEST')
+                else:
+                    print "Client #{0} issued '{1}' command.".format(clId, msg.strip())
+                    try:
+                        self.sendHistory(clId, target, float(mHi.group(2)))
+                    except NeuroError as e:
+                        print "Client #{0} issued '{1}' command but {2}".format(clId, msg.strip(), e)
+                        self.reply(clId, '400 BAD REQUEST')
             elif mH is not None:
                 target = int(mH.group(1))
                 if self.getRole(clId) != "Display" or  self.getRole(target) != 'EEG':
                     print "Client #{0} issued 'getheader' command but not in display role or target is not EEG.".format(clId)
-                    self.send('400 BAD REQUEST', sock)
+                    self.reply(clId, '400 BAD REQUEST')
                 else:
                     print "Client #{0} issued 'getheader {1}' command.".format(clId, target)
-                    #self.send("200 OK", sock)
-                    self.send("200 OK\r\n"+self.getHeader(target), sock)
+                    #self.reply(clId, "200 OK")
+                    self.reply(clId, "200 OK\r\n"+self.getSubscribedHeader(clId, target))
             elif mS is not None:
                 self.setHeader(clId, mS.group(1))
                 print "Client #{0} issued 'setheader' command. Header is now <{1}>.".format(clId, self.getHeader(clId))
-                self.send("200 OK", sock)
+                self.reply(clId, "200 OK")
+                if self.recordDir is not None and self.getRole(clId) == 'EEG':
+                    try:
+                        self.stopRecording(clId)
+                        self.startRecording(clId)
+                    except NeuroError as e:
+                        print "*** Oops! {0}".format(e)
+            elif mB is not None:
+                fmt = mB.group(1) or FLOAT32
+                print "Client #{0} issued 'binary {1}' command.".format(clId, fmt)
+                try:
+                    if self.getRole(clId) == 'EEG':
+                        self.checkFormat(clId, fmt)
+                    for target in self.getWatching(clId):
+                        self.checkFormat(target, fmt)
+                except NeuroError as e:
+                    print "Client #{0} cannot use 'binary {1}': {2}".format(clId, fmt, e)
+                    self.reply(clId, '400 BAD REQUEST')
+                else:
+                    self.reply(clId, "200 OK")
+                    self.formats[clId] = fmt
+            elif mT is not None:
+                window = DEFAULT_WINDOW if mT.group(1) is None else int(mT.group(1))
+                print "Client #{0} issued 'stream {1}' command.".format(clId, window)
+                self.reply(clId, "200 OK")
+                stream = [window, 0, 0]
+                self.streams[clId] = stream
+            elif msg.strip() == 'text':
+                print "Client #{0} issued 'text' command.".format(clId)
+                self.reply(clId, "200 OK")
+                self.formats.pop(clId, None)
             elif mD is not None:
-                if len(self.getWatchers(clId)) > 0:
-                    msg = msg.split()
-                    msg.insert(1, str(clId))
-                    messages.append(' '.join(msg))
-                self.send("200 OK", sock)
+                if not self.hasConsumers(clId) or self.collectLine(blocks, clId, msg):
+                    self.countSamples(clId, int(msg.split(None, 2)[1]), 1)
+                    if stream is None:
+                        self.reply(clId, "200 OK")
+                    else:
+                        stream[1] += 1
+                else:
+                    print "Client #{0} sent malformed sample line.\n{1}".format(clId,msg)
+                    self.reply(clId, '400 BAD REQUEST')
             else:
                 print "Client #{0} issued unrecognized command.\n{1}".format(clId,msg)
-                self.send('400 BAD REQUEST', sock)
-        if self.getRole(clId) == 'EEG':
-            self.getQueues(clId).put('\r\n'.join(messages))
+                self.reply(clId, '400 BAD REQUEST')
+        if stream is not None:
+            self.ackStream(clId, stream)
+        if self.getRole(clId) == 'EEG' and len(blocks) > 0:
+            queue = self.getQueues(clId)
+            now = monotonic()
+            for block in blocks:
+                block.time = now
+                queue.put(block)
+            self.record(clId, blocks)
+            self.dataReady(clId)
+
+    def ackStream(self, clId, stream):
+        r"""Acknowledges the samples received from a streaming uploader.
+        stream is [window, received, acknowledged]; the running count of
+        received samples is sent as "200 OK <count>" once half a window is
+        unacknowledged, so the uploader can keep a full window in flight.
+        With a window of 0 only errors are ever reported.
+        """
+        window, received, acked = stream
+        if window > 0 and received - acked >= max(1, window // 2):
+            self.reply(clId, "200 OK {0}".format(received))
+            stream[2] = received
+
+    def collectLine(self, blocks, clId, msg):
+        r"""Appends the '!' line msg of clId to the last of blocks if it
+        continues its sequence, otherwise starts a new block.
+        """
+        msg = msg.split()
+        try:
+            seq, nChannels = int(msg[1]), int(msg[2])
+        except (ValueError, IndexError):
+            return False
+        if nChannels < 1 or len(msg) != nChannels + 3:
+            return False
+        msg.insert(1, str(clId))
+        line = ' '.join(msg)
+        if len(blocks) > 0:
+            block = blocks[-1]
+            if block.lines is not None and block.nChannels == nChannels and block.seq + len(block.lines) == seq:
+                block.lines.append(line)
+                return True
+        blocks.append(SampleBlock(clId, seq, nChannels, lines = [line]))
+        return True
 
     def recvData(self, clId):
-        data = []
+        r"""Reads the device of clId and returns its packets as SampleBlocks,
+        a new block is started at every sequence gap.
+        """
         sock = self.getSocket(clId)
-        for packet in sock.getData():
-            if clId in self.lastSeq:
-                if self.lastSeq[clId] + 1 != packet[0]:
-                    #raise NeuroError("Sequence number not consistent.")
-                    print "Sequence number not consistent."
-            self.lastSeq[clId] = packet[0]
-            if packet[1] + 2 != len(packet):
-                raise NeuroError("Packet size not consistent.")
-            s = "".join([ " {"+str(i+3)+"}" for i in range(packet[1]) ])
-            data.append(("! {0} {1} {2}" + s).format(clId, *packet))
-        return "\r\n".join(data)
+        if isinstance(sock,(NeuroDeviceProcess,RelaySource)):
+            blocks = sock.getBlocks(clId)
+        else:
+            start = monotonic()
+            blocks = fromPackets(clId, sock.getData())
+            now = monotonic()
+            if self.trace:
+                self.traces['read'].add(now - start)
+            for block in blocks:
+                block.time = now
+        self.record(clId, blocks)
+        for block in blocks:
+            if not self.countSamples(clId, block.seq, block.count):
+                #raise NeuroError("Sequence number not consistent.")
+                print "Sequence number not consistent."
+        return blocks
     
     def cleanup(self):
         print "Trying to shutdown gracefully."
         self.watching.clear()
         self.terminate.set()
         
-        #print self.consumer.name
-        self.consumer.join()
-        for id in self.clients:
+        for id in self.recorders.keys():
+            self.stopRecording(id)
+        if self.relay is not None:
+            self.relay.close()
+        if self.loop is not None:
+            self.loop.close()
+        if self.consumer is not None:
+            #print self.consumer.name
+            self.consumer.join()
+        for id in self.clients.keys():
             thread = self.getThread(id)
             if thread is not None and thread.isAlive():
                 #print thread.name
                 thread.join()
         
-        self.listener.shutdown(0)
-        self.listener.close()
-        for id in self.clients:
+        for listener in self.getListeners():
+            try:
+                listener.shutdown(0)
+            except socket.error:
+                pass
+            listener.close()
+        if self.unixListener is not None:
+            try:
+                os.unlink(self.unixPath)
+            except OSError:
+                pass
+        for id in self.clients.keys():
             sock = self.getSocket(id)
-            if sock is not None and not isinstance(sock,NeuroDevice):
+            if isinstance(sock,NeuroDeviceProcess):
+                sock.close()
+            elif sock is not None and not isinstance(sock,NeuroDevice):
                 sock.shutdown(0)
                 sock.close()
     
+    def startDevices(self, devices):
+        r"""With 'processes' set, starts a process reading each of devices and
+        returns them in place of the devices. All are forked before the server
+        starts any thread, as a thread holding a lock while the process is
+        forked would leave it held in the child.
+        """
+        if not self.processes:
+            return devices
+        processes = [ NeuroDeviceProcess(device, self.ringSize) for device in devices ]
+        for process in processes:
+            process.start(self.getListeners())
+        return processes
+
+    def registerDevice(self, device):
+        r"""Registers device as an EEG client."""
+        clId = self.registerClient('EEG', device.getHeader(), [], NeuroDeviceProducer, device)
+        if self.recordDir is not None:
+            try:
+                self.startRecording(clId)
+            except NeuroError as e:
+                print "*** Oops! {0}".format(e)
+        return clId
+
     def run(self):
         Neuro.run(self)
+        if self.eventLoop:
+            self.loop = NeuroServerLoop(self)
         if isinstance(self.device,NeuroDevice):
-            self.registerClient('EEG', self.device.getHeader(), [], NeuroDeviceProducer, self.device)
+            devices = [self.device]
         else:
-            for device in self.device:
+            devices = list(self.device)
+            for device in devices:
                 if not isinstance(device,NeuroDevice):
                         raise NeuroError("Device must be instance of 'NeuroDevice'.")
-                self.registerClient('EEG', device.getHeader(), [], NeuroDeviceProducer, device)
+        for device in self.startDevices(devices):
+            self.registerDevice(device)
+        if self.upstream is not None:
+            self.relay = NeuroRelay(self.upstream, self.upstreamFormat)
+            self.relay.run()
+            for source in self.relay.getSources():
+                self.registerDevice(source)
+            self.relay.watchAll()
+        print "Server is going to accept connections on address {0}.".format(formatAddress(self.address))
+        if self.unixListener is not None:
+            print "Server is going to accept connections on address {0}{1}.".format(UNIX_PREFIX, self.unixPath)
+        if self.loop is not None:
+            try:
+                self.loop.run()
+            except KeyboardInterrupt:
+                print "Received interupt signal."
+                self.cleanup()
+                raise
+            except Exception as e:
+                self.cleanup()
+                raise
+            return
         self.consumer = NeuroSocketConsumer(self)
         self.consumer.start()
-        print "Server is going to accept connections on address {0}:{1}.".format(*self.address)
+        listeners = self.getListeners()
         while True:
             try:
-                sock, addr =  self.listener.accept()
-                sock.settimeout(10)
-                print "Connected client from {0}:{1}.".format(*addr)
-                clId = self.registerClient('Unknown', '', [], NeuroSocketCommander, sock)
+                readable, writable = wait([ l.fileno() for l in listeners ], [])
+                for listener in listeners:
+                    if listener.fileno() not in readable:
+                        continue
+                    sock, addr =  listener.accept()
+                    sock.settimeout(10)
+                    print "Connected client from {0}.".format(formatAddress(peerAddress(sock)))
+                    clId = self.registerClient('Unknown', '', [], NeuroSocketCommander, sock)
             except KeyboardInterrupt:
                 print "Received interupt signal."
                 self.cleanup()
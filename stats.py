@@ -0,0 +1,77 @@
+from time import time
+from bisect import bisect_left
+
+# upper bounds of latency buckets in seconds, the last bucket is unbounded
+LATENCY_BOUNDS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)
+RATE_WINDOW = 5.0
+
+# stages of a sample block traced by the server:
+#     read      - getData() call of an in-process device
+#     queue     - acquisition until the block is taken from the ingest queue
+#     serialize - encoding and enqueueing the block for all its watchers
+#     send      - enqueue until the block has been written to the socket
+TRACE_STAGES = ('read', 'queue', 'serialize', 'send')
+
+class Histogram(object):
+    r"""Fixed bucket histogram, add() is a bisect and an increment."""
+    def __init__(self, bounds = LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+
+    def add(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+
+    def items(self):
+        r"""Returns (upper bound, count) pairs, None bounds the last bucket."""
+        return zip(self.bounds + (None,), self.counts)
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+
+def formatHistogram(items):
+    r"""Renders non-empty buckets of Histogram.items() as "0.5ms:12,1ms:3"."""
+    return ','.join([ '{0}:{1}'.format('inf' if bound is None else '{0:g}ms'.format(bound*1000), count)
+                      for bound,count in items if count > 0 ])
+
+def percentile(items, fraction):
+    r"""Returns the upper bound of the bucket of Histogram.items() holding
+    the given fraction (0.5 for the median) of all counts. None stands for
+    the unbounded last bucket, 0.0 is returned for an empty histogram.
+    """
+    total = sum([ count for bound,count in items ])
+    if total == 0:
+        return 0.0
+    seen = 0
+    for bound, count in items:
+        seen += count
+        if seen >= fraction * total:
+            return bound
+    return None
+
+class ClientStats(object):
+    r"""Counters of one client. samplesIn and gaps are written only by the
+    thread reading the client. samplesOut is written by the thread
+    broadcasting samples and by commands sending history, always under the
+    server's 'historyLock'. Rates are computed from snapshots of the
+    counters taken at most every RATE_WINDOW seconds.
+    """
+    def __init__(self):
+        self.samplesIn = 0
+        self.samplesOut = 0
+        self.gaps = 0
+        self.started = time()
+        self.marks = [ (self.started, (0, 0, 0, 0)) ]
+
+    def rates(self, counters, now = None):
+        r"""Returns per second rates of counters (a tuple of totals)
+        measured over the last one to two RATE_WINDOW intervals.
+        """
+        if now is None:
+            now = time()
+        if now - self.marks[-1][0] >= RATE_WINDOW:
+            self.marks = self.marks[-1:] + [ (now, counters) ]
+        then, old = self.marks[0]
+        # at least a second, new clients would report bursts otherwise
+        elapsed = max(now - then, 1.0)
+        return tuple([ (c - o) / elapsed for c,o in zip(counters, old) ])